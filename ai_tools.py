@@ -1,6 +1,5 @@
 import types
 from sklearn.neighbors import NearestNeighbors
-import tensorflow_hub as hub
 import numpy as np
 import fitz
 from pathlib import Path
@@ -8,17 +7,72 @@ import urllib.request
 import re
 import json
 import os
+import openai
 from openai import OpenAI
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# Retries are done by LLMClient, which also knows about the rate limits
+openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
 import os
 import docx
 import base64
+import hashlib
+import atexit
+import itertools
+import multiprocessing
+import queue
+import random
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import time
 from dotenv import load_dotenv
 load_dotenv()
 os.environ['OPENAI_API_KEY'] = os.getenv('OPENAI_API_KEY')
 
-recommender_list = {}
+ENCODER_PATH = 'universal-sentence-encoder_4'
+EMBEDDING_CACHE_DIR = os.getenv('EMBEDDING_CACHE_DIR', '.embedding_cache')
+CORPUS_MAX_BYTES = int(os.getenv('CORPUS_MAX_BYTES', 512 * 1024 * 1024))
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', os.cpu_count() or 1))
+PDF_PAGES_PER_TASK = 32
+LLM_CACHE_DIR = os.getenv('LLM_CACHE_DIR', '.llm_cache')
+LLM_CACHE_TTL = int(os.getenv('LLM_CACHE_TTL', 7 * 24 * 3600))
+LLM_CACHE_MAX_BYTES = int(os.getenv('LLM_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Prompt token budgets per model, leaving room in the context for the reply.
+# PROMPT_TOKEN_BUDGET overrides them for every model.
+PROMPT_TOKEN_BUDGETS = {
+    'gpt-3.5-turbo-16k': 10000,
+    'gpt-4-vision-preview': 6000,
+}
+DEFAULT_PROMPT_TOKEN_BUDGET = 3000
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', 0))
+NEAR_DUPLICATE_SIMILARITY = 0.8
+FLASHCARD_WORKERS = int(os.getenv('FLASHCARD_WORKERS', 4))
+FLASHCARD_RETRIES = 3
+# Smaller sections mean more calls in parallel and more cards per page
+FLASHCARD_SECTION_TOKENS = int(os.getenv('FLASHCARD_SECTION_TOKENS', 3000))
+FLASHCARD_DB_PATH = os.getenv('FLASHCARD_DB_PATH', 'flashcards.sqlite3')
+LLM_REQUESTS_PER_MINUTE = int(os.getenv('LLM_REQUESTS_PER_MINUTE', 500))
+LLM_TOKENS_PER_MINUTE = int(os.getenv('LLM_TOKENS_PER_MINUTE', 160000))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 6))
+LLM_MAX_BACKOFF = 60
+# Reply tokens charged against the tokens/minute limit up front, per choice
+LLM_COMPLETION_TOKENS = 1000
+RETRY_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+# 'dense' (sentence embeddings), 'lexical' (BM25, no encoder at query time)
+# or 'hybrid' (both scores, normalized and mixed)
+RETRIEVAL_MODES = ('dense', 'hybrid', 'lexical')
+RETRIEVAL_MODE = os.getenv('RETRIEVAL_MODE', 'dense')
+BM25_K1 = 1.2
+BM25_B = 0.75
+HYBRID_DEPTH = 50
+HYBRID_DENSE_WEIGHT = float(os.getenv('HYBRID_DENSE_WEIGHT', 0.5))
+FLASHCARD_DUPLICATE_SIMILARITY = 0.9
 
 # Function to encode the image
 
@@ -28,56 +82,371 @@ def encode_image(image_path):
         return base64.b64encode(image_file.read()).decode('utf-8')
 
 
-def call_gpt3(messages, n=1, temperature=1, model='gpt-3.5-turbo-16k', image_path: str = "") -> str:
+class ResponseCache:
+    # Content-addressed cache of chat completions on disk. Entries expire
+    # after `ttl` seconds and the least recently used ones are deleted once
+    # the cache grows past max_bytes. Identical requests made while one is
+    # already in flight wait for its result instead of calling the API again.
+    def __init__(self, cache_dir=LLM_CACHE_DIR, ttl=LLM_CACHE_TTL, max_bytes=LLM_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model, messages, temperature, n=1, image_hash=None):
+        request = {"model": model, "messages": messages, "temperature": temperature,
+                   "n": n, "image": image_hash}
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                response = json.load(f)
+            os.utime(path)  # Mark as recently used
+            return response
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, response):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(response, f)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.json'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes and now - mtime <= self.ttl:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def get_or_call(self, key, call):
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+        if not owner:
+            self.hits += 1
+            return future.result()
+        try:
+            self.misses += 1
+            response = call()
+            self.put(key, response)
+            future.set_result(response)
+            return response
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+
+response_cache = ResponseCache()
+
+
+class RateLimiter:
+    # Token bucket shared by every thread; acquire() blocks until `amount`
+    # fits under per_minute and returns how long it waited.
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self._allowance = per_minute
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self.capacity, self._allowance + (now - self._last) * self.rate)
+            self._last = now
+            self._allowance -= amount
+            delay = -self._allowance / self.rate if self._allowance < 0 else 0
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+def is_retryable(error):
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    return getattr(error, 'status_code', None) in RETRY_STATUS_CODES
+
+
+def retry_after(error):
+    # Seconds the server asked us to wait, if it said
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass  # An HTTP date; fall back to backoff
+    return None
+
+
+class LLMClient:
+    # Stands in for the OpenAI client in call_gpt3. Requests wait for the
+    # requests/minute and tokens/minute buckets, and rate limit, timeout and
+    # server errors are retried with exponential backoff and full jitter, or
+    # after the server's retry-after when it sends one.
+    def __init__(self, llm_client, requests_per_minute=LLM_REQUESTS_PER_MINUTE,
+                 tokens_per_minute=LLM_TOKENS_PER_MINUTE, max_retries=LLM_MAX_RETRIES):
+        self.llm_client = llm_client
+        self.request_limiter = RateLimiter(requests_per_minute)
+        self.token_limiter = RateLimiter(tokens_per_minute)
+        self.max_retries = max_retries
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.queue_wait = 0.0
+        self.backoff_wait = 0.0
+        self._lock = threading.Lock()
+
+    def estimate_tokens(self, kwargs):
+        prompt = 0
+        for message in kwargs.get('messages', []):
+            content = message.get('content')
+            if isinstance(content, str):
+                prompt += count_tokens(content, kwargs.get('model', 'gpt-3.5-turbo-16k'))
+        completion = kwargs.get('max_tokens') or LLM_COMPLETION_TOKENS
+        return prompt + completion * kwargs.get('n', 1)
+
+    def create(self, **kwargs):
+        tokens = self.estimate_tokens(kwargs)
+        for attempt in range(self.max_retries + 1):
+            waited = self.request_limiter.acquire() + self.token_limiter.acquire(tokens)
+            with self._lock:
+                self.requests += 1
+                self.queue_wait += waited
+            try:
+                return self.llm_client.chat.completions.create(**kwargs)
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    with self._lock:
+                        self.failures += 1
+                    raise
+                delay = retry_after(e)
+                if delay is None:
+                    delay = random.uniform(0, min(LLM_MAX_BACKOFF, 2 ** attempt))
+                with self._lock:
+                    self.retries += 1
+                    self.backoff_wait += delay
+                print(f"LLM request failed ({e.__class__.__name__}), retry {attempt + 1} in {delay:.1f}s")
+                time.sleep(delay)
+
+    def report(self):
+        return (f"{self.requests} LLM requests, {self.retries} retries, {self.failures} failures, "
+                f"{self.queue_wait:.1f}s waiting for rate limits, {self.backoff_wait:.1f}s backing off")
+
+
+client = LLMClient(openai_client)
+
+
+def call_gpt3(messages, n=1, temperature=1, model='gpt-3.5-turbo-16k', image_path: str = "",
+              use_cache=True, llm_client=None, stream=False):
+    # llm_client defaults to the module's rate limited client; anything with a
+    # compatible chat.completions.create can be passed instead. With
+    # stream=True a generator of content deltas is returned instead of the
+    # response.
+    llm_client = llm_client or client
+    image_hash = None
     if image_path != None and image_path != "":
-        response = client.chat.completions.create(model="gpt-4-vision-preview",
-        messages=messages +
-        [{"content": [
+        model = "gpt-4-vision-preview"
+        image_hash = file_digest(str(image_path))
+
+    def request_messages():
+        if image_hash is None:
+            return messages
+        return messages + [{"content": [
             {
                 "type": "image_url",
                 "image_url": {
                     "url": f"data:image/jpeg;base64,{encode_image(str(image_path))}"
                 }
             }
-        ], "role": "user"}],
-        temperature=temperature, n=n)
-        print(response)
+        ], "role": "user"}]
+
+    def request():
+        response = llm_client.chat.completions.create(model=model,
+                                                      messages=request_messages(),
+                                                      temperature=temperature, n=n)
+        # Plain dicts can be cached and indexed like the pre-1.0 client's responses
+        response = response.model_dump() if hasattr(response, 'model_dump') else response
+        # Printed here, so cache hits and waiters aren't reported as billed
+        if image_hash is not None:
+            print(response)
+        elif response.get("usage"):
+            cost_prompt = float(response["usage"]["prompt_tokens"])/1000*0.001
+            cost_completion_tokens = float(
+                response["usage"]["completion_tokens"])/1000*0.002
+            print(cost_prompt + cost_completion_tokens)
+        return response
 
+    def stream_request(key):
+        cached = response_cache.get(key) if key else None
+        if cached is not None:
+            response_cache.hits += 1
+            yield cached['choices'][0]['message']['content']
+            return
+        response_cache.misses += 1
+        parts = []
+        for chunk in llm_client.chat.completions.create(model=model,
+                                                        messages=request_messages(),
+                                                        temperature=temperature, stream=True):
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                yield delta
+        if key:
+            # Only complete streams are cached, in the same shape as a
+            # regular response.
+            response_cache.put(key, {"choices": [{"message": {
+                "role": "assistant", "content": ''.join(parts)}}], "usage": None})
+
+    key = ResponseCache.key(model, messages, temperature, n, image_hash) if use_cache else None
+    if stream:
+        return stream_request(key)
+    if use_cache:
+        response = response_cache.get_or_call(key, request)
     else:
-        response = client.chat.completions.create(model=model,
-        messages=messages,
-        temperature=temperature, n=n)
-        cost_prompt = float(response["usage"]["prompt_tokens"])/1000*0.001
-        cost_completion_tokens = float(
-            response["usage"]["completion_tokens"])/1000*0.002
-        print(cost_prompt + cost_completion_tokens)
+        response = request()
     return response
 
 
+WHITESPACE_PATTERN = re.compile(r'\s+')
+TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]')
+CHUNK_MODES = ('words', 'tokens', 'sliding')
+_unit_patterns = {}
+
+
 def preprocess(text):
-    text = text.replace('\n', ' ')
-    text = re.sub('\s+', ' ', text)
-    return text
-
-
-def text_to_chunks(texts, word_length=150, start_page=1):
-    text_toks = [t.split(' ') for t in texts]
-    chunks = []
-
-    for idx, words in enumerate(text_toks):
-        for i in range(0, len(words), word_length):
-            chunk = words[i: i + word_length]
-            if (
-                (i + word_length) > len(words)
-                and (len(chunk) < word_length)
-                and (len(text_toks) != (idx + 1))
-            ):
-                text_toks[idx + 1] = chunk + text_toks[idx + 1]
+    return WHITESPACE_PATTERN.sub(' ', text)
+
+
+def _units_pattern(unit, count):
+    # Matches up to `count` words (split on single spaces, like str.split(' '))
+    # or tokens from a position, so a chunk is one regex match sliced out of
+    # the page instead of a list of words joined back together.
+    key = (unit, count)
+    if key not in _unit_patterns:
+        if unit == 'tokens':
+            pattern = r'(?:\s*(?:\w+|[^\w\s])){1,%d}' % count
+        else:
+            pattern = r'[^ ]*(?: [^ ]*){0,%d}' % (count - 1)
+        _unit_patterns[key] = re.compile(pattern)
+    return _unit_patterns[key]
+
+
+def _next_unit(unit, match):
+    # Words are separated by exactly one space, which the match leaves out.
+    return match.end() + (1 if unit == 'words' else 0)
+
+
+def iter_chunks(pages, word_length=150, start_page=1, mode='words', overlap=0):
+    # Chunks pages as they arrive. 'words' splits pages into runs of
+    # word_length words, 'tokens' counts word and punctuation tokens instead,
+    # and 'sliding' emits word windows overlapping by `overlap` words. A
+    # page's short final chunk is carried into the next page, so one page of
+    # lookahead is kept to know whether the current page is the last one.
+    if mode not in CHUNK_MODES:
+        raise ValueError(f"Unknown chunking mode: {mode}")
+    step = word_length - overlap if mode == 'sliding' else word_length
+    if step <= 0:
+        raise ValueError("overlap must be smaller than word_length")
+    unit = 'tokens' if mode == 'tokens' else 'words'
+
+    pages = iter(pages)
+    page = next(pages, None)
+    page_no = start_page
+    carry, carried = '', 0
+    while page is not None:
+        next_page = next(pages, None)
+        pos = 0
+        while True:
+            match = _units_pattern(unit, word_length - carried).match(page, pos)
+            if match is None:
+                break  # No tokens left on this page
+            text = match.group()
+            if unit == 'words':
+                count = text.count(' ') + 1
+                at_end = match.end() == len(page)
+            else:
+                count = len(TOKEN_PATTERN.findall(text))
+                at_end = TOKEN_PATTERN.search(page, match.end()) is None
+            if carried:
+                text = carry + ' ' + text
+            if at_end and count + carried < word_length and next_page is not None:
+                carry, carried = text, count + carried
+                break
+            yield f'[Page no. {page_no}]' + ' ' + '"' + text.strip() + '"'
+            if at_end:
+                carry, carried = '', 0
+                if mode == 'sliding' and next_page is not None:
+                    # Overlap the first window of the next page with this one
+                    carry_words = text.split(' ')[step:]
+                    carry, carried = ' '.join(carry_words), len(carry_words)
+                break
+            advance = step - carried
+            if advance <= 0:
+                # The next sliding window still starts inside the carried words
+                carry_words = carry.split(' ')[step:]
+                carry, carried = ' '.join(carry_words), len(carry_words)
                 continue
-            chunk = ' '.join(chunk).strip()
-            chunk = f'[Page no. {idx+start_page}]' + ' ' + '"' + chunk + '"'
-            chunks.append(chunk)
-    return chunks
+            carry, carried = '', 0
+            if advance < count:
+                match = _units_pattern(unit, advance).match(page, pos)
+            pos = _next_unit(unit, match)
+        page = next_page
+        page_no += 1
+
+
+def text_to_chunks(texts, word_length=150, start_page=1, mode='words', overlap=0):
+    return list(iter_chunks(texts, word_length=word_length, start_page=start_page,
+                            mode=mode, overlap=overlap))
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
 
 
 def read_txt(file_path):
@@ -94,28 +463,31 @@ def read_docx(file_path):
     return [preprocess('\n'.join(text))]
 
 
-def pdf_to_text(file_path, start_page=1, end_page=None):
+def iter_pdf_pages(file_path, start_page=1, end_page=None):
     doc = fitz.open(file_path)
-    total_pages = doc.page_count
+    try:
+        if end_page is None:
+            end_page = doc.page_count
+        for i in range(start_page - 1, end_page):
+            yield preprocess(doc.load_page(i).get_text("text"))
+    finally:
+        doc.close()
 
-    if end_page is None:
-        end_page = total_pages
 
-    text_list = []
+def pdf_to_text(file_path, start_page=1, end_page=None):
+    return list(iter_pdf_pages(file_path, start_page=start_page, end_page=end_page))
 
-    for i in range(start_page - 1, end_page):
-        text = doc.load_page(i).get_text("text")
-        text = preprocess(text)
-        text_list.append(text)
 
-    doc.close()
-    return text_list
+def iter_file_pages(file_path, start_page=1, end_page=None):
+    if file_path.endswith(".pdf"):
+        return iter_pdf_pages(file_path, start_page=start_page, end_page=end_page)
+    return iter(file_to_text(file_path, start_page=start_page, end_page=end_page))
 
 
-def file_to_text(file_path, start_page=1):
+def file_to_text(file_path, start_page=1, end_page=None):
     _, file_extension = os.path.splitext(file_path)
     if file_extension == ".pdf":
-        return pdf_to_text(file_path, start_page=start_page)
+        return pdf_to_text(file_path, start_page=start_page, end_page=end_page)
     elif file_extension == ".txt":
         return read_txt(file_path)
     elif file_extension == ".docx":
@@ -124,32 +496,998 @@ def file_to_text(file_path, start_page=1):
         raise ValueError("File format not supported")
 
 
-def load_recommender(path, start_page=1, end_page=None):
-    global recommender_list
-    recommender = SemanticSearch()
-    recommender_list[path] = recommender
-    texts = file_to_text(path, start_page=start_page)
-    chunks = text_to_chunks(texts, start_page=start_page)
-    recommender.fit(chunks)
+def pdf_page_count(file_path):
+    with fitz.open(file_path) as doc:
+        return doc.page_count
+
+
+_extraction_pool = None
+_extraction_pool_lock = threading.Lock()
+
+
+def extraction_pool():
+    # One process pool for the life of the app, started with forkserver (or
+    # spawn where that is unavailable) so the workers don't inherit the Tk,
+    # encoder and HTTP threads of the parent, and shut down at exit.
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            _extraction_pool = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS, mp_context=context)
+        return _extraction_pool
+
+
+@atexit.register
+def shutdown_extraction_pool():
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is not None:
+            _extraction_pool.shutdown(cancel_futures=True)
+            _extraction_pool = None
+
+
+def extract_texts(file_paths, start_page=1, workers=None,
+                  pages_per_task=PDF_PAGES_PER_TASK, skip_errors=False):
+    # Fans the files, and page ranges of large PDFs, out over the extraction
+    # pool and yields (file_path, texts) in the order the files were given,
+    # with each file's pages in page order. Only a few page ranges are in
+    # flight ahead of the consumer, so extracted text doesn't pile up while
+    # earlier files are still being embedded.
+    workers = workers or EXTRACTION_WORKERS
+    tasks = []
+    for file_path in file_paths:
+        ranges = [(start_page, None)]
+        if file_path.endswith('.pdf'):
+            try:
+                page_count = pdf_page_count(file_path)
+                ranges = [(first, min(first + pages_per_task - 1, page_count))
+                          for first in range(start_page, page_count + 1, pages_per_task)]
+            except Exception:
+                pass  # Let the extraction task report the error
+        tasks.append((file_path, ranges))
+
+    if workers <= 1 or sum(len(ranges) for _, ranges in tasks) <= 1:
+        for file_path, ranges in tasks:
+            try:
+                texts = []
+                for first, last in ranges:
+                    texts.extend(file_to_text(file_path, start_page=first, end_page=last))
+            except Exception as e:
+                if not skip_errors:
+                    raise
+                print(f"Failed to extract text from {file_path}. Reason: {e}")
+                continue
+            yield file_path, texts
+        return
+
+    pool = extraction_pool()
+    pending = iter((file_path, first, last) for file_path, ranges in tasks for first, last in ranges)
+    in_flight = {}
+    submitted = 0
+
+    def submit_ahead(limit):
+        nonlocal submitted
+        while len(in_flight) < limit:
+            task = next(pending, None)
+            if task is None:
+                return
+            in_flight[submitted] = pool.submit(file_to_text, *task)
+            submitted += 1
+
+    consumed = 0
+    try:
+        for file_path, ranges in tasks:
+            texts, error = [], None
+            for _ in ranges:
+                submit_ahead(2 * workers)
+                future = in_flight.pop(consumed)
+                consumed += 1
+                if error is not None:
+                    future.cancel()
+                    continue
+                try:
+                    texts.extend(future.result())
+                except BrokenProcessPool:
+                    shutdown_extraction_pool()
+                    raise
+                except Exception as e:
+                    error = e
+            if error is not None:
+                if not skip_errors:
+                    raise error
+                print(f"Failed to extract text from {file_path}. Reason: {error}")
+                continue
+            yield file_path, texts
+    finally:
+        for future in in_flight.values():
+            future.cancel()
+
+
+_digest_cache = {}
+
+
+def file_digest(path, block_size=1 << 20):
+    # Remember digests by (mtime, size) so checking an already indexed file
+    # on every question doesn't re-read the whole file.
+    stat = os.stat(path)
+    cached = _digest_cache.get(path)
+    if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    _digest_cache[path] = ((stat.st_mtime_ns, stat.st_size), digest.hexdigest())
+    return digest.hexdigest()
+
+
+def embedding_cache_key(path, word_length=150, start_page=1, end_page=None, mode='words', overlap=0):
+    # The chunking parameters and encoder are part of the key so changing
+    # either never serves vectors computed for a different chunking.
+    params = f'{ENCODER_PATH}|{mode}|{word_length}|{overlap}|{start_page}|{end_page}'
+    return hashlib.sha256(f'{file_digest(path)}|{params}'.encode()).hexdigest()
+
+
+class EmbeddingStore:
+    # Writers and readers of an entry hold its key's lock, so the refresh
+    # and the corpus manager can't interleave their .npy and .json files.
+    def __init__(self, cache_dir=EMBEDDING_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return base + '.npy', base + '.json'
+
+    def lock(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    @staticmethod
+    def _tmp(path):
+        return f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+    def __contains__(self, key):
+        return all(os.path.isfile(path) for path in self._paths(key))
+
+    def load(self, key):
+        with self.lock(key):
+            return self._load(key)
+
+    def _load(self, key):
+        embeddings_path, meta_path = self._paths(key)
+        if not (os.path.isfile(embeddings_path) and os.path.isfile(meta_path)):
+            return None
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            embeddings = np.load(embeddings_path, mmap_mode='r')
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable embedding cache entry {key}. Reason: {e}")
+            return None
+        if len(meta['chunks']) != embeddings.shape[0]:
+            return None
+        return meta['chunks'], embeddings
+
+    def save(self, key, chunks, embeddings, source=None):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        embeddings_path, meta_path = self._paths(key)
+        # Write to temporary files and rename so an interrupted run never
+        # leaves a half-written entry behind. The metadata goes last, so its
+        # presence marks the entry as complete.
+        with self.lock(key):
+            tmp_path = self._tmp(embeddings_path)
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.asarray(embeddings, dtype=np.float32))
+            os.replace(tmp_path, embeddings_path)
+            self._save_meta(meta_path, chunks, source)
+
+    def _save_meta(self, meta_path, chunks, source):
+        tmp_path = self._tmp(meta_path)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"source": source, "chunks": chunks}, f)
+        os.replace(tmp_path, meta_path)
+
+    def save_stream(self, key, chunks, encode, batch=1000, source=None, dim=512):
+        # Embeds chunks batch by batch, appending raw vectors to disk, and
+        # only then lays them out as a .npy matrix through a memory map, so
+        # memory use does not grow with the size of the document.
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with self.lock(key):
+            return self._save_stream(key, chunks, encode, batch, source, dim)
+
+    def _save_stream(self, key, chunks, encode, batch, source, dim):
+        embeddings_path, meta_path = self._paths(key)
+        raw_path = self._tmp(embeddings_path + '.raw')
+        tmp_path = self._tmp(embeddings_path)
+        # The temporary files are removed if encoding or reading the pages
+        # fails partway, so a failed save leaves nothing behind.
+        try:
+            saved = []
+            with open(raw_path, 'wb') as raw:
+                for chunk_batch in batched(chunks, batch):
+                    vectors = np.asarray(encode(chunk_batch), dtype=np.float32)
+                    raw.write(vectors.tobytes())
+                    saved.extend(chunk_batch)
+            rows = len(saved)
+            if rows == 0:
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, np.empty((0, dim), dtype=np.float32))
+            else:
+                source_rows = np.memmap(raw_path, dtype=np.float32, mode='r', shape=(rows, dim))
+                out = np.lib.format.open_memmap(
+                    tmp_path, mode='w+', dtype=np.float32, shape=(rows, dim))
+                for start in range(0, rows, batch):
+                    out[start: start + batch] = source_rows[start: start + batch]
+                out.flush()
+                del out, source_rows
+            os.remove(raw_path)
+            os.replace(tmp_path, embeddings_path)
+            self._save_meta(meta_path, saved, source)
+        finally:
+            for path in (raw_path, tmp_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        return saved
+
+    def remove(self, key):
+        with self.lock(key):
+            for path in self._paths(key):
+                if os.path.isfile(path):
+                    os.remove(path)
+
+
+embedding_store = EmbeddingStore()
+
+_encoder = None
+_encoder_lock = threading.Lock()
+encoder_timings = {}
+
+
+def get_encoder():
+    # The SavedModel is deserialized once per process and shared by every
+    # SemanticSearch; the lock keeps concurrent first callers from loading
+    # it twice.
+    global _encoder
+    if _encoder is None:
+        with _encoder_lock:
+            if _encoder is None:
+                # Imported here so lexical search never loads TensorFlow
+                import tensorflow_hub as hub
+                start = time.perf_counter()
+                _encoder = hub.load(ENCODER_PATH)
+                encoder_timings['load'] = time.perf_counter() - start
+    return _encoder
+
+
+def encoder_timing_report():
+    if 'load' not in encoder_timings:
+        return f"{ENCODER_PATH} not loaded yet."
+    report = f"{ENCODER_PATH} loaded in {encoder_timings['load']:.2f}s"
+    if 'first_call' in encoder_timings:
+        report += f", first embedding in {encoder_timings['first_call']:.2f}s"
+    return report
+
+
+def warm_up_encoder(background=True):
+    def warm_up():
+        try:
+            encoder = get_encoder()
+            start = time.perf_counter()
+            encoder(['warm up'])
+            encoder_timings['first_call'] = time.perf_counter() - start
+            print(encoder_timing_report())
+        except Exception as e:
+            print(f"Failed to warm up {ENCODER_PATH}. Reason: {e}")
+
+    if not background:
+        warm_up()
+        return None
+    thread = threading.Thread(target=warm_up, daemon=True)
+    thread.start()
+    return thread
+
+
+PAGE_PATTERN = re.compile(r'\[Page no\. (\d+)\]')
+LEXICAL_PATTERN = re.compile(r'\w+')
+
+
+def lexical_tokens(text):
+    return LEXICAL_PATTERN.findall(text.lower())
+
+
+def fuse_scores(dense, lexical, k, dense_weight=HYBRID_DENSE_WEIGHT):
+    # Mixes the cosine similarity and the BM25 score of the same candidates,
+    # with BM25 given as a fraction of a full match (see full_match_score)
+    # and both clipped to [0, 1]; a candidate sharing no term with the query
+    # has BM25 score 0. The scales are fixed rather than stretched over the
+    # candidates, so a chunk matching a rare query term, e.g. a course code,
+    # keeps its lead over chunks matching only common words, while queries
+    # whose words are all common are ordered by the dense term. Returns
+    # (order, scores) of the best k.
+    def clipped(scores):
+        return np.clip(np.where(np.isfinite(scores), scores, 0.0), 0.0, 1.0)
+    fused = dense_weight * clipped(dense) + (1 - dense_weight) * clipped(lexical)
+    order = np.argsort(-fused, kind='stable')[:k]
+    return order, fused[order]
+
+
+def full_match_score(idf):
+    # BM25 of a chunk of average length holding each query term once, the
+    # score hybrid search treats as a full lexical match.
+    return max(sum(idf.values()), 1e-6)
+
+
+class LexicalIndex:
+    # BM25 over the words of each chunk. Postings are flat arrays: the
+    # chunks containing term t are doc_ids[offsets[t]:offsets[t + 1]], in
+    # chunk order, with the term's count in each in term_freqs.
+    def __init__(self, chunks):
+        self.vocabulary = {}
+        lengths = np.zeros(len(chunks), dtype=np.int64)
+        tokens = []
+        for doc, chunk in enumerate(chunks):
+            match = PAGE_PATTERN.match(chunk)
+            chunk_tokens = lexical_tokens(chunk[match.end():] if match else chunk)
+            lengths[doc] = len(chunk_tokens)
+            tokens.extend(chunk_tokens)
+        term_ids = np.fromiter((self.vocabulary.setdefault(token, len(self.vocabulary))
+                                for token in tokens), dtype=np.int64, count=len(tokens))
+        docs = np.repeat(np.arange(len(chunks), dtype=np.int64), lengths)
+        # One (term, chunk) pair per posting, sorted by term then chunk
+        pairs, counts = np.unique(term_ids * max(len(chunks), 1) + docs, return_counts=True)
+        self.doc_ids = (pairs % max(len(chunks), 1)).astype(np.int32)
+        self.term_freqs = counts.astype(np.float32)
+        self.offsets = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pairs // max(len(chunks), 1), minlength=len(self.vocabulary)),
+                  out=self.offsets[1:])
+        lengths = lengths.astype(np.float32)
+        self.lengths = lengths
+        self.size = len(chunks)
+
+    @property
+    def nbytes(self):
+        return self.doc_ids.nbytes + self.term_freqs.nbytes + self.offsets.nbytes + self.lengths.nbytes
+
+    def document_frequency(self, term):
+        term_id = self.vocabulary.get(term)
+        return 0 if term_id is None else int(self.offsets[term_id + 1] - self.offsets[term_id])
+
+    def idf(self, terms):
+        idf = {}
+        for term in set(terms):
+            df = self.document_frequency(term)
+            if df:
+                idf[term] = np.log(1 + (self.size - df + 0.5) / (df + 0.5))
+        return idf
+
+    def scores(self, terms, idf=None, avgdl=None, k1=BM25_K1, b=BM25_B):
+        # idf and avgdl default to this index's own statistics; a search
+        # over several indexes passes the combined ones.
+        scores = np.zeros(self.size, dtype=np.float32)
+        if self.size == 0:
+            return scores
+        avgdl = avgdl or max(float(self.lengths.mean()), 1.0)
+        idf = self.idf(terms) if idf is None else idf
+        norms = k1 * (1 - b + b * self.lengths / avgdl)
+        for term in set(terms):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, stop = self.offsets[term_id], self.offsets[term_id + 1]
+            term_idf = idf.get(term, 0.0)
+            docs = self.doc_ids[start:stop]
+            freqs = self.term_freqs[start:stop]
+            scores[docs] += term_idf * freqs * (k1 + 1) / (freqs + norms[docs])
+        return scores
+
+    def search(self, query, k=5):
+        scores = self.scores(lexical_tokens(query))
+        matches = np.flatnonzero(scores > 0)
+        if len(matches) > k:
+            matches = matches[np.argpartition(-scores[matches], k - 1)[:k]]
+        matches = matches[np.argsort(-scores[matches], kind='stable')]
+        return matches, scores[matches]
+
+
+class CourseIndex:
+    # One contiguous matrix of unit-normalized chunk embeddings for every
+    # loaded file, so a query is a single matrix product instead of one
+    # nearest-neighbour search per file.
+    def __init__(self, dim=512):
+        self.dim = dim
+        self.size = 0
+        self._vectors = np.empty((0, dim), dtype=np.float32)
+        self._row_files = np.empty(0, dtype=np.int32)
+        self.row_pages = np.empty(0, dtype=np.int32)
+        self.chunks = []
+        self.files = {}
+        self._file_ids = {}
+        self._masks = {}
+
+    def __contains__(self, path):
+        return path in self.files
+
+    @property
+    def embeddings(self):
+        return self._vectors[:self.size]
+
+    def _reserve(self, rows):
+        if rows > len(self._vectors):
+            self._resize(max(rows, 2 * len(self._vectors), 1024))
+
+    def _resize(self, capacity):
+        vectors = np.empty((capacity, self.dim), dtype=np.float32)
+        vectors[:self.size] = self._vectors[:self.size]
+        row_files = np.empty(capacity, dtype=np.int32)
+        row_files[:self.size] = self._row_files[:self.size]
+        row_pages = np.empty(capacity, dtype=np.int32)
+        row_pages[:self.size] = self.row_pages[:self.size]
+        self._vectors, self._row_files, self.row_pages = vectors, row_files, row_pages
+
+    def add(self, path, chunks, embeddings, key=None):
+        if path in self.files:
+            self.remove(path)
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        start, stop = self.size, self.size + len(chunks)
+        self._reserve(stop)
+        self._vectors[start:stop] = vectors / norms
+        file_id = self._file_ids.setdefault(path, len(self._file_ids))
+        self._row_files[start:stop] = file_id
+        for row, chunk in enumerate(chunks, start):
+            match = PAGE_PATTERN.match(chunk)
+            self.row_pages[row] = int(match.group(1)) if match else 0
+        self.chunks.extend(chunks)
+        self.size = stop
+        lexical = LexicalIndex(chunks)
+        # Counted once here so the memory budget is checked without
+        # walking the file's chunks on every load
+        nbytes = (len(chunks) * self.dim * self._vectors.itemsize
+                  + sum(len(chunk) for chunk in chunks) + lexical.nbytes)
+        self.files[path] = {"start": start, "stop": stop, "key": key,
+                            "lexical": lexical, "bytes": nbytes}
+        self._masks.clear()
+
+    def remove(self, path):
+        entry = self.files.pop(path, None)
+        if entry is None:
+            return
+        start, stop = entry["start"], entry["stop"]
+        removed = stop - start
+        tail = slice(stop, self.size)
+        self._vectors[start:self.size - removed] = self._vectors[tail]
+        self._row_files[start:self.size - removed] = self._row_files[tail]
+        self.row_pages[start:self.size - removed] = self.row_pages[tail]
+        del self.chunks[start:stop]
+        self.size -= removed
+        for other in self.files.values():
+            if other["start"] >= stop:
+                other["start"] -= removed
+                other["stop"] -= removed
+        if len(self._vectors) > 1024 and self.size < len(self._vectors) // 4:
+            self._resize(max(2 * self.size, 1024))
+        self._masks.clear()
+
+    def file_bytes(self, path):
+        return self.files[path]["bytes"]
+
+    def _file_paths(self):
+        paths = [None] * len(self._file_ids)
+        for path, file_id in self._file_ids.items():
+            paths[file_id] = path
+        return paths
+
+    def mask(self, paths):
+        # Masks are cached per selection and only rebuilt when rows change.
+        selection = frozenset(paths)
+        if selection not in self._masks:
+            ids = [self._file_ids[p] for p in selection if p in self.files]
+            self._masks[selection] = np.isin(self._row_files[:self.size], ids)
+        return self._masks[selection]
+
+    def dense_scores(self, query_embeddings, paths=None):
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        queries = queries / np.maximum(
+            np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        scores = queries @ self.embeddings.T
+        if paths is not None:
+            scores[:, ~self.mask(paths)] = -np.inf
+        return scores
+
+    def lexical_stats(self, terms, paths=None):
+        # Document frequencies and lengths combined over the searched files,
+        # so BM25 scores compare across files. Returns (paths, idf, avgdl).
+        selected = [path for path in (self.files if paths is None else paths) if path in self.files]
+        indexes = [self.files[path]["lexical"] for path in selected]
+        total = sum(index.size for index in indexes)
+        avgdl = max(sum(float(index.lengths.sum()) for index in indexes) / max(total, 1), 1.0)
+        idf = {}
+        for term in set(terms):
+            df = sum(index.document_frequency(term) for index in indexes)
+            if df:
+                idf[term] = np.log(1 + (total - df + 0.5) / (df + 0.5))
+        return selected, idf, avgdl
+
+    def lexical_scores(self, query, paths=None, full_match=False):
+        # BM25 over the searched files, as a fraction of a full match when
+        # `full_match` is set. Chunks sharing no term with the query score
+        # -inf.
+        terms = lexical_tokens(query)
+        scores = np.full(self.size, -np.inf, dtype=np.float32)
+        selected, idf, avgdl = self.lexical_stats(terms, paths)
+        if not selected or not terms:
+            return scores
+        scale = full_match_score(idf) if full_match else 1.0
+        for path in selected:
+            entry = self.files[path]
+            file_scores = entry["lexical"].scores(terms, idf, avgdl) / scale
+            file_scores[file_scores <= 0] = -np.inf
+            scores[entry["start"]:entry["stop"]] = file_scores
+        return scores
+
+    @staticmethod
+    def top_rows(row_scores, k):
+        top = min(k, int(np.isfinite(row_scores).sum()))
+        if top == 0:
+            return np.empty(0, dtype=np.int64)
+        best = np.argpartition(-row_scores, top - 1)[:top]
+        return best[np.argsort(-row_scores[best])]
+
+    def results(self, rows, scores):
+        file_paths = self._file_paths()
+        return [{
+            "score": float(score),
+            "path": file_paths[self._row_files[row]],
+            "page": int(self.row_pages[row]),
+            "chunk": self.chunks[row],
+        } for row, score in zip(rows, scores)]
+
+    def search(self, query_embeddings, k=5, paths=None):
+        results = []
+        for row_scores in self.dense_scores(query_embeddings, paths):
+            rows = self.top_rows(row_scores, k)
+            results.append(self.results(rows, row_scores[rows]))
+        return results
+
+    def lexical_search(self, query, k=5, paths=None):
+        scores = self.lexical_scores(query, paths)
+        rows = self.top_rows(scores, k)
+        return self.results(rows, scores[rows])
+
+    def hybrid_search(self, query, query_embedding, k=5, paths=None, depth=HYBRID_DEPTH):
+        # Candidates are the top `depth` chunks of each ranking
+        depth = max(depth, k)
+        dense = self.dense_scores(query_embedding, paths)[0]
+        lexical = self.lexical_scores(query, paths, full_match=True)
+        rows = np.union1d(self.top_rows(dense, depth), self.top_rows(lexical, depth))
+        order, scores = fuse_scores(dense[rows], lexical[rows], k)
+        return self.results(rows[order], scores)
+
+
+class CorpusManager:
+    # Keeps the loaded files (corpora) in least-recently-used order and
+    # unloads the oldest ones from the course index once the resident
+    # embeddings exceed max_bytes. Evicted files reload from the embedding
+    # store when they are needed again.
+    def __init__(self, index, max_bytes=CORPUS_MAX_BYTES):
+        self.index = index
+        self.max_bytes = max_bytes
+        self.corpora = OrderedDict()
+        self._resident_bytes = 0
+        self._loading = {}
+        self._lock = threading.RLock()
+
+    def __contains__(self, path):
+        return path in self.corpora
+
+    def __len__(self):
+        return len(self.corpora)
+
+    def is_current(self, path, key):
+        with self._lock:
+            return path in self.corpora and self.index.files[path]["key"] == key
+
+    def load(self, path, start_page=1, end_page=None, word_length=150, keep=(), texts=None,
+             mode='words', overlap=0):
+        key = embedding_cache_key(path, word_length, start_page, end_page, mode, overlap)
+        with self._lock:
+            if self.is_current(path, key):
+                self.corpora.move_to_end(path)
+                return self.corpora[path]
+            # A file being loaded by another thread (the background indexer
+            # or another question) is waited for, not embedded twice.
+            future = self._loading.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._loading[key] = future
+        if not owner:
+            future.result()
+            return self.load(path, start_page, end_page, word_length, keep, mode=mode, overlap=overlap)
+        try:
+            recommender = SemanticSearch()
+            cached = embedding_store.load(key)
+            if cached is None:
+                if texts is None:
+                    texts = iter_file_pages(path, start_page=start_page, end_page=end_page)
+                chunks = iter_chunks(texts, word_length=word_length, start_page=start_page,
+                                     mode=mode, overlap=overlap)
+                embedding_store.save_stream(key, chunks, recommender.use, source=path)
+                cached = embedding_store.load(key)
+            if cached is None:
+                raise RuntimeError(f"Embeddings for {path} could not be read back from the cache")
+            chunks, embeddings = cached
+            recommender.fit(chunks, embeddings=embeddings)
+            with self._lock:
+                self.corpora[path] = recommender
+                self.corpora.move_to_end(path)
+                if path in self.index:
+                    self._resident_bytes -= self.index.file_bytes(path)
+                self.index.add(path, chunks, embeddings, key=key)
+                self._resident_bytes += self.index.file_bytes(path)
+                self.evict(keep=set(keep) | {path})
+            future.set_result(None)
+            return recommender
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+
+    def wait_for(self, key):
+        # Blocks until a load of `key` in progress in another thread is done
+        with self._lock:
+            future = self._loading.get(key)
+        if future is not None:
+            try:
+                future.result()
+            except Exception:
+                pass  # The loading thread reports its own failure
+
+    def load_many(self, paths, start_page=1, word_length=150, keep=()):
+        # Files that are neither loaded nor in the embedding store have
+        # their text extracted in parallel, and each file is embedded as
+        # soon as its text arrives while the pool works on the next ones.
+        missing = []
+        for path in paths:
+            key = embedding_cache_key(path, word_length, start_page)
+            if not self.is_current(path, key) and key not in embedding_store \
+                    and key not in self._loading:
+                missing.append(path)
+        extracted = extract_texts(list(missing), start_page=start_page)
+        waiting = set(missing)
+        for path in paths:
+            texts = None
+            if path in waiting:
+                waiting.discard(path)
+                # Files come out in the order given, matched by path
+                for extracted_path, extracted_texts in extracted:
+                    if extracted_path == path:
+                        texts = extracted_texts
+                        break
+            self.load(path, start_page=start_page, word_length=word_length,
+                      keep=keep, texts=texts)
+
+    def unload(self, path):
+        with self._lock:
+            if self.corpora.pop(path, None) is not None:
+                self._resident_bytes -= self.index.file_bytes(path)
+                self.index.remove(path)
+
+    def unload_all(self):
+        with self._lock:
+            for path in list(self.corpora):
+                self.unload(path)
+
+    def evict(self, keep=()):
+        with self._lock:
+            for path in list(self.corpora):
+                if self.resident_bytes() <= self.max_bytes:
+                    break
+                if path not in keep:
+                    print(f"Unloading {path} to stay under the corpus memory budget.")
+                    self.unload(path)
+            if self.resident_bytes() > self.max_bytes:
+                print(f"Selected files need {self.resident_bytes()} bytes, "
+                      f"over the {self.max_bytes} byte corpus budget.")
+
+    def resident_bytes(self, path=None):
+        with self._lock:
+            if path is not None:
+                return self.index.file_bytes(path) if path in self.corpora else 0
+            return self._resident_bytes
+
+    def memory_report(self):
+        with self._lock:
+            return {path: self.index.file_bytes(path) for path in self.corpora}
+
+    def search(self, query_embeddings, k=5, paths=None):
+        with self._lock:
+            return self.index.search(query_embeddings, k=k, paths=paths)
+
+    def retrieve(self, query, k=5, paths=None, mode=RETRIEVAL_MODE):
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode {mode!r}, expected one of {RETRIEVAL_MODES}")
+        if mode == 'lexical':
+            with self._lock:
+                return self.index.lexical_search(query, k=k, paths=paths)
+        query_embedding = get_encoder()([query])
+        with self._lock:
+            if mode == 'dense':
+                return self.index.search(query_embedding, k=k, paths=paths)[0]
+            return self.index.hybrid_search(query, query_embedding, k=k, paths=paths)
+
+
+course_index = CourseIndex()
+corpus_manager = CorpusManager(course_index)
+
+
+def load_recommender(path, start_page=1, end_page=None, word_length=150):
+    corpus_manager.load(path, start_page=start_page, end_page=end_page,
+                        word_length=word_length)
     return 'Corpus Loaded.'
 
 
+SUPPORTED_EXTENSIONS = ('.pdf', '.txt', '.docx')
+
+
+def text_digest(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class IncrementalIndexer:
+    # Tracks every indexed file in a manifest (mtime, size, content hash and
+    # per-page text hashes). A refresh skips files whose stat or hash is
+    # unchanged, and for changed files only embeds chunks whose text is new,
+    # copying the vectors of unchanged chunks from the previous store entry.
+    # Chunks that disappeared are counted as tombstones and dropped with
+    # the old entry.
+    def __init__(self, store=embedding_store, word_length=150):
+        self.store = store
+        self.word_length = word_length
+        self.manifest_path = os.path.join(store.cache_dir, 'manifest.json')
+        self.files = {}
+        if os.path.isfile(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                    self.files = json.load(f)["files"]
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Ignoring unreadable index manifest. Reason: {e}")
+
+    def save(self):
+        os.makedirs(self.store.cache_dir, exist_ok=True)
+        with open(self.manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({"files": self.files}, f)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def refresh(self, folder):
+        start = time.perf_counter()
+        folder = os.path.abspath(folder)
+        summary = {"unchanged": 0, "indexed": 0, "removed": 0, "pages_changed": 0,
+                   "chunks_embedded": 0, "chunks_reused": 0, "chunks_tombstoned": 0}
+        seen = set()
+        changed = {}
+        for root, _, names in os.walk(folder):
+            for name in names:
+                if not name.endswith(SUPPORTED_EXTENSIONS):
+                    continue
+                path = os.path.join(root, name)
+                seen.add(path)
+                try:
+                    stat, digest = self._check_file(path)
+                except OSError as e:
+                    print(f"Failed to index {path}. Reason: {e}")
+                    continue
+                if stat is None:
+                    summary["unchanged"] += 1
+                else:
+                    changed[path] = (stat, digest)
+        for path, texts in extract_texts(list(changed), skip_errors=True):
+            try:
+                self._reindex_file(path, texts, *changed[path], summary)
+            except Exception as e:
+                print(f"Failed to index {path}. Reason: {e}")
+        for path in list(self.files):
+            if path.startswith(folder + os.sep) and path not in seen:
+                entry = self.files.pop(path)
+                self.store.remove(entry["key"])
+                corpus_manager.unload(path)
+                summary["removed"] += 1
+                summary["chunks_tombstoned"] += entry["chunks"]
+        self.save()
+        summary["seconds"] = round(time.perf_counter() - start, 2)
+        print(f"Index refresh for {folder}: {summary}")
+        return summary
+
+    def _check_file(self, path):
+        # Returns (stat, digest) for files that need re-indexing and
+        # (None, None) for unchanged ones.
+        stat = os.stat(path)
+        entry = self.files.get(path)
+        if entry and entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+            return None, None
+        digest = file_digest(path)
+        if entry and entry["sha256"] == digest:
+            entry["mtime_ns"], entry["size"] = stat.st_mtime_ns, stat.st_size
+            return None, None
+        return stat, digest
+
+    def _reindex_file(self, path, texts, stat, digest, summary):
+        entry = self.files.get(path)
+        # The page hashes only feed the pages_changed count; what is
+        # re-embedded is decided per chunk below.
+        page_hashes = [text_digest(text) for text in texts]
+        old_pages = entry["pages"] if entry else []
+        summary["pages_changed"] += sum(
+            1 for i, page_hash in enumerate(page_hashes)
+            if i >= len(old_pages) or old_pages[i] != page_hash)
+
+        key = embedding_cache_key(path, word_length=self.word_length)
+        # Let a load of the same entry by the app finish, then reuse it
+        corpus_manager.wait_for(key)
+        old_key = entry["key"] if entry else key
+        old = self.store.load(old_key)
+        if old is not None and old_key == key:
+            # A file seen for the first time may already have been embedded
+            # under this key when it was selected in the app.
+            chunk_count, embedded, tombstoned = len(old[0]), 0, 0
+        else:
+            old_rows, old_embeddings = {}, None
+            if old is not None:
+                old_chunks, old_embeddings = old
+                old_rows = {text_digest(chunk): row for row, chunk in enumerate(old_chunks)}
+            seen = set()
+            encoder = SemanticSearch()
+            embedded = 0
+
+            def encode(batch):
+                # Copies the vectors of unchanged chunks from the old entry
+                # and only embeds the new ones, a batch at a time.
+                nonlocal embedded
+                vectors = np.empty((len(batch), 512), dtype=np.float32)
+                missing = []
+                for row, chunk in enumerate(batch):
+                    chunk_hash = text_digest(chunk)
+                    seen.add(chunk_hash)
+                    if chunk_hash in old_rows:
+                        vectors[row] = old_embeddings[old_rows[chunk_hash]]
+                    else:
+                        missing.append(row)
+                if missing:
+                    vectors[missing] = encoder.get_text_embedding([batch[row] for row in missing])
+                embedded += len(missing)
+                return vectors
+
+            chunks = iter_chunks(texts, word_length=self.word_length)
+            chunk_count = len(self.store.save_stream(key, chunks, encode, source=path))
+            tombstoned = len(set(old_rows) - seen)
+            if entry and entry["key"] != key:
+                self.store.remove(entry["key"])
+        self.files[path] = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size,
+                            "sha256": digest, "key": key, "pages": page_hashes,
+                            "chunks": chunk_count}
+        summary["indexed"] += 1
+        summary["chunks_embedded"] += embedded
+        summary["chunks_reused"] += chunk_count - embedded
+        summary["chunks_tombstoned"] += tombstoned
+
+
+class BackgroundIndexer:
+    # Loads files into the corpus manager on a daemon thread before a
+    # question needs them. Files a submitted question is waiting for
+    # (QUERY) are taken before files that were only selected (PREFETCH).
+    QUERY = 0
+    PREFETCH = 1
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.keep = set()
+        self._queue = queue.PriorityQueue()
+        self._priorities = {}
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def enqueue(self, paths, priority=PREFETCH):
+        with self._lock:
+            for path in paths:
+                if not path.endswith(SUPPORTED_EXTENSIONS) or not os.path.isfile(path):
+                    continue
+                current = self._priorities.get(path)
+                if current is not None and current <= priority:
+                    continue
+                # An entry queued at a lower priority stays in the queue
+                # and is skipped when it comes up.
+                self._priorities[path] = priority
+                self._queue.put((priority, next(self._order), path))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def select(self, paths):
+        # The selected files are prefetched and kept loaded
+        self.keep = set(paths)
+        self.enqueue(paths, self.PREFETCH)
+
+    def prioritize(self, paths):
+        self.enqueue(paths, self.QUERY)
+
+    def _run(self):
+        while True:
+            priority, _, path = self._queue.get()
+            with self._lock:
+                if self._priorities.get(path) != priority:
+                    continue
+            start = time.perf_counter()
+            try:
+                self.manager.load(path, keep=self.keep | {path})
+                print(f"Indexed {os.path.basename(path)} in the background "
+                      f"in {time.perf_counter() - start:.2f}s")
+            except Exception as e:
+                print(f"Background indexing of {path} failed: {e}")
+            finally:
+                with self._lock:
+                    if self._priorities.get(path) == priority:
+                        del self._priorities[path]
+
+
+background_indexer = BackgroundIndexer(corpus_manager)
+
+
+def refresh_course_index(course_folder):
+    return IncrementalIndexer().refresh(course_folder)
+
+
 class SemanticSearch:
     def __init__(self):
-        self.use = hub.load('universal-sentence-encoder_4')
         self.fitted = False
 
-    def fit(self, data, batch=1000, n_neighbors=5):
+    @property
+    def use(self):
+        return get_encoder()
+
+    def fit(self, data, batch=1000, n_neighbors=5, embeddings=None):
         self.data = data
-        self.embeddings = self.get_text_embedding(data, batch=batch)
-        n_neighbors = min(n_neighbors, len(self.embeddings))
-        self.nn = NearestNeighbors(n_neighbors=n_neighbors)
-        self.nn.fit(self.embeddings)
+        if embeddings is None:
+            embeddings = self.get_text_embedding(data, batch=batch)
+        self.embeddings = embeddings
+        self.n_neighbors = min(n_neighbors, len(self.embeddings))
+        # The neighbour and BM25 indexes are only built if this file is
+        # searched on its own; the course index has its own.
+        self.nn = None
+        self.lexical = None
         self.fitted = True
 
-    def __call__(self, text, return_data=True):
-        inp_emb = self.use([text])
-        neighbors = self.nn.kneighbors(inp_emb, return_distance=False)[0]
+    def dense_neighbors(self, inp_emb, n_neighbors):
+        if self.nn is None:
+            self.nn = NearestNeighbors(n_neighbors=self.n_neighbors)
+            self.nn.fit(self.embeddings)
+        return self.nn.kneighbors(inp_emb, n_neighbors=n_neighbors, return_distance=False)[0]
+
+    def __call__(self, text, return_data=True, mode='dense'):
+        if mode in ('lexical', 'hybrid') and self.lexical is None:
+            self.lexical = LexicalIndex(self.data)
+        if mode == 'lexical':
+            neighbors = self.lexical.search(text, k=self.n_neighbors)[0]
+        elif mode == 'hybrid':
+            inp_emb = np.asarray(self.use([text]), dtype=np.float32)
+            depth = min(max(HYBRID_DEPTH, self.n_neighbors), len(self.embeddings))
+            candidates = np.union1d(self.dense_neighbors(inp_emb, depth),
+                                    self.lexical.search(text, k=depth)[0])
+            vectors = self.embeddings[candidates]
+            dense = (vectors @ inp_emb[0]) / np.maximum(
+                np.linalg.norm(vectors, axis=1) * np.linalg.norm(inp_emb[0]), 1e-12)
+            terms = lexical_tokens(text)
+            lexical = self.lexical.scores(terms)[candidates] / full_match_score(self.lexical.idf(terms))
+            order, _ = fuse_scores(dense, lexical, self.n_neighbors)
+            neighbors = candidates[order]
+        else:
+            neighbors = self.dense_neighbors(self.use([text]), self.n_neighbors)
 
         if return_data:
             return [self.data[i] for i in neighbors]
@@ -157,29 +1495,115 @@ class SemanticSearch:
             return neighbors
 
     def get_text_embedding(self, texts, batch=1000):
-        embeddings = []
+        if not texts:
+            return np.empty((0, 512), dtype=np.float32)
+        embeddings = None
         for i in range(0, len(texts), batch):
             text_batch = texts[i: (i + batch)]
-            emb_batch = self.use(text_batch)
-            embeddings.append(emb_batch)
-        embeddings = np.vstack(embeddings)
+            emb_batch = np.asarray(self.use(text_batch), dtype=np.float32)
+            if embeddings is None:
+                embeddings = np.empty((len(texts), emb_batch.shape[1]), dtype=np.float32)
+            embeddings[i: i + len(text_batch)] = emb_batch
         return embeddings
 
 
-def generate_text(prompt, image=None, engine='gpt-3.5-turbo-16k'):
-    try:
-        messages = [{"content": prompt, "role": "user"}]
-        completions = call_gpt3(messages, image_path=image, n=1, model=engine)
-        message = completions['choices'][0]['message']['content']
-    except Exception as e:
-        message = f'API Error: {str(e)}'
-    return message
+_encodings = {}
 
 
-def generate_flashcards(file_paths=[], context=""):
+def _get_encoding(model):
+    if model not in _encodings:
+        encoding = None
+        if tiktoken is not None:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding('cl100k_base')
+            except Exception as e:
+                # The BPE files are downloaded on first use
+                print(f"tiktoken unavailable ({e}), estimating token counts")
+        _encodings[model] = encoding
+    return _encodings[model]
 
-    # get the first 2 pages of each file
-    prompt = '''You are flashcardGPT, an AI designed to look at random extracts from a stundent's course material and generate flashcards for them. \n\n Your output should be a fully planned out flashcard unit for the given material. \n\n 
+
+def count_tokens(text, model='gpt-3.5-turbo-16k'):
+    encoding = _get_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    # Without tiktoken, count words and punctuation and charge long words
+    # one extra token per 4 characters, which errs on the high side for
+    # English text.
+    return sum(1 + (len(token) - 1) // 4 for token in TOKEN_PATTERN.findall(text))
+
+
+def prompt_budget(model):
+    return PROMPT_TOKEN_BUDGET or PROMPT_TOKEN_BUDGETS.get(model, DEFAULT_PROMPT_TOKEN_BUDGET)
+
+
+def shingles(text, size=3):
+    words = TOKEN_PATTERN.findall(text.lower())
+    if len(words) <= size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def pack_chunks(chunks, budget, model='gpt-3.5-turbo-16k', similarity=NEAR_DUPLICATE_SIMILARITY,
+                separator='\n\n'):
+    # Greedily takes chunks in rank order while they fit in `budget` tokens,
+    # skipping any that overlap an already packed chunk by `similarity` or
+    # more (Jaccard similarity of word 3-grams). Returns the packed chunks,
+    # the tokens they use, and how many were dropped as duplicates or for
+    # size.
+    packed = []
+    packed_shingles = []
+    used = 0
+    duplicates = 0
+    oversized = 0
+    separator_tokens = count_tokens(separator, model)
+    for chunk in chunks:
+        chunk_shingles = shingles(chunk)
+        if any(len(chunk_shingles & other) >= similarity * len(chunk_shingles | other)
+               for other in packed_shingles):
+            duplicates += 1
+            continue
+        tokens = count_tokens(chunk, model) + separator_tokens
+        if used + tokens > budget:
+            oversized += 1
+            continue
+        packed.append(chunk)
+        packed_shingles.append(chunk_shingles)
+        used += tokens
+    return packed, used, duplicates, oversized
+
+
+def build_prompt(head, chunks, tail, model='gpt-3.5-turbo-16k', budget=None, separator='\n\n'):
+    # Fills whatever the budget leaves after `head` and `tail` with the
+    # highest ranked chunks.
+    budget = budget or prompt_budget(model)
+    fixed = count_tokens(head, model) + count_tokens(tail, model)
+    chunks = list(chunks)
+    packed, used, duplicates, oversized = pack_chunks(
+        chunks, max(budget - fixed, 0), model, separator=separator)
+    print(f"Prompt: {fixed + used}/{budget} tokens for {model}, {len(packed)}/{len(chunks)} chunks "
+          f"({duplicates} near-duplicates, {oversized} over budget)")
+    return head + ''.join(chunk + separator for chunk in packed) + tail
+
+
+def generate_text(prompt, image=None, engine='gpt-3.5-turbo-16k', stream=False):
+    # API errors are raised once the client has given up retrying
+    if stream:
+        return generate_text_stream(prompt, image=image, engine=engine)
+    messages = [{"content": prompt, "role": "user"}]
+    completions = call_gpt3(messages, image_path=image, n=1, model=engine)
+    return completions['choices'][0]['message']['content']
+
+
+def generate_text_stream(prompt, image=None, engine='gpt-3.5-turbo-16k'):
+    messages = [{"content": prompt, "role": "user"}]
+    yield from call_gpt3(messages, image_path=image, n=1, model=engine, stream=True)
+
+
+def flashcard_prompt(context=""):
+    return '''You are flashcardGPT, an AI designed to look at random extracts from a stundent's course material and generate flashcards for them. \n\n Your output should be a fully planned out flashcard unit for the given material. \n\n 
      Your student's context :''' + context + '''\n\nYour student's material: \n\nYour output should be json of the following format: \n\n
      ***
 {
@@ -233,16 +1657,239 @@ def generate_flashcards(file_paths=[], context=""):
         He is studying the following material: \n\n
      '''
 
-    for file_path in file_paths:
-        texts = file_to_text(file_path, start_page=3)
+
+def parse_flashcards(answer):
+    # The model sometimes wraps the JSON in *** or prose, so only the outer
+    # object is parsed.
+    start, end = answer.find('{'), answer.rfind('}')
+    cards = json.loads(answer[start:end + 1])["flashcards"]
+    return [card for card in cards if card.get("question") and card.get("answer")]
+
+
+def split_sections(texts, budget, model='gpt-3.5-turbo-16k', overhead=0):
+    # Packs texts in order into sections of at most `budget` tokens, each
+    # text costing `overhead` tokens on top of its own. Texts too large for
+    # a section on their own are halved on spaces until they fit.
+    sections = []
+    section = []
+    used = 0
+    pending = list(reversed(texts))
+    while pending:
+        text = pending.pop()
+        tokens = count_tokens(text, model) + overhead
+        words = text.split(' ')
+        if tokens > budget and len(words) > 1:
+            half = len(words) // 2
+            pending.append(' '.join(words[half:]))
+            pending.append(' '.join(words[:half]))
+            continue
+        if section and used + tokens > budget:
+            sections.append(section)
+            section = []
+            used = 0
+        section.append(text)
+        used += tokens
+    if section:
+        sections.append(section)
+    return sections
+
+
+def section_flashcards(head, section, model='gpt-3.5-turbo-16k', retries=FLASHCARD_RETRIES):
+    # Only replies that don't parse are retried here; API errors have
+    # already been retried by the client and are raised to the caller.
+    prompt = head + ''.join(f'***{text}*** \n\n' for text in section)
+    messages = [{"content": prompt, "role": "user"}]
+    for attempt in range(retries):
+        # A cached reply that failed to parse would fail again, so
+        # retries go to the API.
+        response = call_gpt3(messages, model=model, use_cache=attempt == 0)
+        try:
+            return parse_flashcards(response['choices'][0]['message']['content'])
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            print(f"Unparseable flashcard reply ({e}), attempt {attempt + 1} of {retries}")
+    print("Giving up on flashcard section")
+    return None
+
+
+def dedup_flashcards(cards, similarity=FLASHCARD_DUPLICATE_SIMILARITY, existing=()):
+    # Drops cards whose question embeds within `similarity` (cosine) of an
+    # earlier card's question or of one of the `existing` questions.
+    existing = list(existing)
+    questions = existing + [card["question"] for card in cards]
+    if not cards or len(questions) < 2:
+        return cards
+    embeddings = SemanticSearch().get_text_embedding(questions)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-12
+    kept = list(range(len(existing)))
+    for i in range(len(existing), len(questions)):
+        if kept and np.max(embeddings[kept] @ embeddings[i]) >= similarity:
+            continue
+        kept.append(i)
+    return [cards[i - len(existing)] for i in kept[len(existing):]]
+
+
+def map_flashcards(file_paths, context="", model='gpt-3.5-turbo-16k', workers=FLASHCARD_WORKERS,
+                   progress=None):
+    # Generates cards for each file's sections concurrently and returns
+    # {path: cards}. A file whose text couldn't be extracted is left out,
+    # and one with a section that failed every retry maps to None.
+    head = flashcard_prompt(context)
+    budget = min(prompt_budget(model) - count_tokens(head, model), FLASHCARD_SECTION_TOKENS)
+    overhead = count_tokens('****** \n\n', model)
+    cards = {}
+    jobs = []
+    for path, texts in extract_texts(file_paths, skip_errors=True):
+        cards[path] = []
+        texts = [text for text in texts if text.strip()]
+        jobs.extend((path, section) for section in split_sections(texts, budget, model, overhead))
+    print(f"Generating flashcards for {len(cards)} files in {len(jobs)} sections")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda job: section_flashcards(head, job[1], model), jobs)
+        for done, ((path, _), section_cards) in enumerate(zip(jobs, results), 1):
+            if progress is not None:
+                progress(f"{done}/{len(jobs)} sections")
+            if section_cards is None or cards[path] is None:
+                cards[path] = None
+            else:
+                cards[path].extend(section_cards)
+    return cards
+
+
+def generate_flashcards_map_reduce(file_paths=[], context="", model='gpt-3.5-turbo-16k',
+                                   workers=FLASHCARD_WORKERS):
+    start = time.perf_counter()
+    results = map_flashcards(file_paths, context, model, workers)
+    cards = [card for file_cards in results.values() for card in file_cards or []]
+    unique = dedup_flashcards(cards)
+    print(f"Generated {len(unique)} flashcards ({len(cards) - len(unique)} duplicates dropped) "
+          f"in {time.perf_counter() - start:.2f}s, {client.report()}")
+    return {"flashcards": unique}
+
+
+class FlashcardStore:
+    # Flashcards kept in SQLite under the digest of the file they were
+    # generated from, so a selection's deck only needs cards generated for
+    # files that haven't been seen before.
+    def __init__(self, path=FLASHCARD_DB_PATH):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript('''
+                CREATE TABLE IF NOT EXISTS sources (
+                    file_hash TEXT PRIMARY KEY,
+                    path TEXT,
+                    created REAL
+                );
+                CREATE TABLE IF NOT EXISTS cards (
+                    id INTEGER PRIMARY KEY,
+                    file_hash TEXT NOT NULL,
+                    question TEXT NOT NULL,
+                    answer TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS cards_by_source ON cards (file_hash, id);
+            ''')
+        return self._conn
+
+    def _query(self, sql, file_hashes, params=()):
+        marks = ','.join('?' * len(file_hashes))
+        with self._lock:
+            return self._connection().execute(sql.format(marks), list(file_hashes) + list(params)).fetchall()
+
+    def missing(self, file_hashes):
+        known = {row[0] for row in self._query(
+            'SELECT file_hash FROM sources WHERE file_hash IN ({})', file_hashes)}
+        return [file_hash for file_hash in file_hashes if file_hash not in known]
+
+    def add(self, file_hash, path, cards):
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?)',
+                             (file_hash, path, time.time()))
+                conn.execute('DELETE FROM cards WHERE file_hash = ?', (file_hash,))
+                conn.executemany('INSERT INTO cards (file_hash, question, answer) VALUES (?, ?, ?)',
+                                 [(file_hash, card["question"], card["answer"]) for card in cards])
+
+    def count(self, file_hashes):
+        return self._query('SELECT COUNT(*) FROM cards WHERE file_hash IN ({})', file_hashes)[0][0]
+
+    def questions(self, file_hashes):
+        return [row[0] for row in self._query(
+            'SELECT question FROM cards WHERE file_hash IN ({}) ORDER BY id', file_hashes)]
+
+    def page(self, file_hashes, offset, limit):
+        rows = self._query('SELECT question, answer FROM cards WHERE file_hash IN ({}) '
+                           'ORDER BY id LIMIT ? OFFSET ?', file_hashes, (limit, offset))
+        return [{"question": question, "answer": answer} for question, answer in rows]
+
+
+flashcard_store = FlashcardStore()
+
+
+class FlashcardDeck:
+    # The cards of a set of source files, read from the store a page at a
+    # time.
+    def __init__(self, file_hashes, store=None):
+        self.file_hashes = list(file_hashes)
+        self.store = store or flashcard_store
+        self._len = self.store.count(self.file_hashes) if self.file_hashes else 0
+
+    def __len__(self):
+        return self._len
+
+    def page(self, offset, limit):
+        return self.store.page(self.file_hashes, offset, limit) if self.file_hashes else []
+
+
+def build_flashcard_deck(file_paths, context="", store=None, progress=None):
+    # Generates cards only for files whose contents aren't in the store yet
+    # and returns the deck of every selected file.
+    store = store or flashcard_store
+    hashes = {}
+    for path in file_paths:
+        hashes.setdefault(file_digest(path), path)
+    missing = store.missing(list(hashes))
+    if missing:
+        known = store.questions([file_hash for file_hash in hashes if file_hash not in missing])
+        generated = map_flashcards([hashes[file_hash] for file_hash in missing], context,
+                                   progress=progress)
+        for file_hash in missing:
+            cards = generated.get(hashes[file_hash])
+            if cards is None:
+                print(f"No flashcards stored for {hashes[file_hash]}, it will be retried next time")
+                continue
+            cards = dedup_flashcards(cards, existing=known)
+            store.add(file_hash, hashes[file_hash], cards)
+            known.extend(card["question"] for card in cards)
+    deck = FlashcardDeck(hashes, store)
+    print(f"Deck of {len(deck)} flashcards from {len(hashes)} files ({len(missing)} newly generated), "
+          f"{client.report()}")
+    return deck
+
+
+def generate_flashcards(file_paths=[], context="", map_reduce=False):
+    if map_reduce:
+        return generate_flashcards_map_reduce(file_paths, context)
+
+    # get the first 2 pages of each file
+    prompt = flashcard_prompt(context)
+
+    pages = []
+    for file_path, texts in extract_texts(file_paths, start_page=3):
         if len(texts) != 0:
-            for text in texts:
-                if len(prompt) > 5000:
-                    break
-                prompt += f'***{str(text)}*** \n\n'
+            pages.append([f'***{str(text)}***' for text in texts])
         else:
             return {"flashcards": []}
 
+    # Take pages from each file in turn so every file gets into the prompt
+    # when the budget runs out.
+    ranked = [page for group in itertools.zip_longest(*pages) for page in group if page is not None]
+    prompt = build_prompt(prompt, ranked, '', model="gpt-3.5-turbo-16k", separator=' \n\n')
     print(prompt)
     answer = generate_text(prompt, engine="gpt-3.5-turbo-16k")
     print(answer)
@@ -253,22 +1900,23 @@ def generate_flashcards(file_paths=[], context=""):
     # return flashcards
 
 
-def generate_answer(question: str, file_paths=[], context: str = None, image: str = None):
-    for filename in file_paths:
-        load_recommender(filename)
+def generate_answer(question: str, file_paths=[], context: str = None, image: str = None, top_k=30,
+                    stream=False, mode=RETRIEVAL_MODE):
+    # top_k is the number of candidate chunks; as many of them as fit in the
+    # model's prompt budget are sent, best first.
+    start = time.perf_counter()
+    corpus_manager.load_many(file_paths, keep=file_paths)
 
     topn_chunks = []
-    for recommender in recommender_list.keys():
-        print(f"************Searching in {recommender}***************")
-        chunks_found = recommender_list[recommender](question)[:5]
-        for chunk in chunks_found:
+    if file_paths:
+        results = corpus_manager.retrieve(question, k=top_k, paths=file_paths, mode=mode)
+        for result in results:
+            chunk = f'[{os.path.basename(result["path"])}] {result["chunk"]}'
             print(f"\n*********************{chunk}************************\n")
-        topn_chunks.extend(chunks_found)
-    prompt = ""
-    prompt += 'search results:\n\n'
-    for c in topn_chunks:
-        prompt += c + '\n\n'
-    prompt += f'Context :\n\n{context}'
+            topn_chunks.append(chunk)
+    print(f"Retrieval took {time.perf_counter() - start:.2f}s ({encoder_timing_report()}, "
+          f"{corpus_manager.resident_bytes()} bytes resident in {len(corpus_manager)} corpora)")
+    prompt = f'Context :\n\n{context}'
     prompt += (
         "Instructions: Compose a comprehensive reply to the query using the search results given and the context of the question"
         "Cite each reference using [ Page Number] notation (every result has this number at the beginning). "
@@ -278,5 +1926,6 @@ def generate_answer(question: str, file_paths=[], context: str = None, image: st
     )
 
     prompt += f"Query: {question}\nAnswer:"
-    answer = generate_text(prompt, image=image, engine="gpt-4-vision-preview")
+    prompt = build_prompt('search results:\n\n', topn_chunks, prompt, model="gpt-4-vision-preview")
+    answer = generate_text(prompt, image=image, engine="gpt-4-vision-preview", stream=stream)
     return answer
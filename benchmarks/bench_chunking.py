@@ -0,0 +1,70 @@
+# Chunking throughput on large PDFs, compared with the original
+# list-based text_to_chunks.
+#
+#   python benchmarks/bench_chunking.py [file.pdf ...]
+#
+# Without arguments a synthetic 2,000 page document is used.
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ai_tools import pdf_to_text, preprocess, text_to_chunks  # noqa: E402
+
+
+def legacy_text_to_chunks(texts, word_length=150, start_page=1):
+    text_toks = [t.split(' ') for t in texts]
+    chunks = []
+
+    for idx, words in enumerate(text_toks):
+        for i in range(0, len(words), word_length):
+            chunk = words[i: i + word_length]
+            if (
+                (i + word_length) > len(words)
+                and (len(chunk) < word_length)
+                and (len(text_toks) != (idx + 1))
+            ):
+                text_toks[idx + 1] = chunk + text_toks[idx + 1]
+                continue
+            chunk = ' '.join(chunk).strip()
+            chunk = f'[Page no. {idx+start_page}]' + ' ' + '"' + chunk + '"'
+            chunks.append(chunk)
+    return chunks
+
+
+def synthetic_pages(pages=2000, words_per_page=450, seed=0):
+    rng = random.Random(seed)
+    vocabulary = ['lecture', 'theorem', 'proof', 'matrix', 'gradient', 'CSC148',
+                  'e.g.', 'O(n log n)', 'recursion', 'the', 'of', 'and', 'is']
+    # Short pages force the carry-into-next-page path regularly.
+    return [preprocess(' '.join(rng.choice(vocabulary)
+                                for _ in range(rng.randint(20, words_per_page))))
+            for _ in range(pages)]
+
+
+def throughput(name, chunker, pages, repeats=5):
+    size_mb = sum(len(page.encode('utf-8')) for page in pages) / 1e6
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        chunks = chunker(list(pages))
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<28}{size_mb / best:>10.1f} MB/s{len(chunks):>10} chunks")
+
+
+def main(paths):
+    if paths:
+        pages = [page for path in paths for page in pdf_to_text(path)]
+    else:
+        pages = synthetic_pages()
+    print(f"{len(pages)} pages, {sum(map(len, pages)) / 1e6:.1f} MB of text\n")
+    throughput("legacy text_to_chunks", legacy_text_to_chunks, pages)
+    throughput("words", lambda p: text_to_chunks(p), pages)
+    throughput("tokens", lambda p: text_to_chunks(p, mode='tokens'), pages)
+    throughput("sliding (overlap 30)",
+               lambda p: text_to_chunks(p, mode='sliding', overlap=30), pages)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
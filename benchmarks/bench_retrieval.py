@@ -0,0 +1,125 @@
+# Retrieval latency and recall@k of the dense, hybrid and lexical modes on
+# a synthetic course: chunks on a handful of topics, some mentioning a rare
+# term (a course code or a named formula) that the query also mentions.
+#
+#   python benchmarks/bench_retrieval.py [chunks] [queries]
+#
+# Dense scoring uses the Universal Sentence Encoder when it is available
+# and a hashed bag-of-words stand-in otherwise; the lexical mode never
+# needs either.
+import os
+import random
+import sys
+import time
+import zlib
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ai_tools import CourseIndex, ENCODER_PATH, get_encoder, lexical_tokens  # noqa: E402
+
+TOPICS = {
+    'graphs': ['vertex', 'edge', 'path', 'cycle', 'tree', 'traversal', 'shortest', 'weighted'],
+    'probability': ['random', 'variable', 'expectation', 'variance', 'distribution', 'sample'],
+    'calculus': ['derivative', 'integral', 'limit', 'series', 'gradient', 'convergence'],
+    'psychology': ['cognitive', 'dissonance', 'memory', 'attention', 'behaviour', 'bias'],
+    'economics': ['supply', 'demand', 'market', 'price', 'elasticity', 'equilibrium'],
+}
+COMMON = ['the', 'of', 'and', 'is', 'a', 'lecture', 'example', 'we', 'this', 'in', 'week']
+RARE_PREFIXES = ['CSC', 'MAT', 'STA', 'PSY', 'ECO']
+FORMULAS = ['lagrangian', 'hessian', 'jacobian', 'bellman', 'kolmogorov', 'dijkstra']
+FILES = 10
+KS = (1, 5, 10)
+
+
+def synthetic_course(chunks=20000, queries=500, seed=0):
+    rng = random.Random(seed)
+    topics = list(TOPICS)
+    texts, targets, questions = [], [], []
+    for row in range(chunks):
+        topic = rng.choice(topics)
+        words = [rng.choice(TOPICS[topic] if rng.random() < 0.4 else COMMON)
+                 for _ in range(rng.randint(60, 150))]
+        texts.append((topic, words))
+    for row in rng.sample(range(chunks), queries):
+        topic, words = texts[row]
+        if rng.random() < 0.5:
+            rare = f'{rng.choice(RARE_PREFIXES)}{rng.randint(100, 499)}{row}'
+        else:
+            rare = f'{rng.choice(FORMULAS)}{row}'
+        words.insert(rng.randrange(len(words)), rare)
+        targets.append(row)
+        questions.append(f'what does {rare} say about {" ".join(rng.sample(TOPICS[topic], 2))}')
+    pages = [f'[Page no. {row // 3 + 1}] "{" ".join(words)}"' for row, (_, words) in enumerate(texts)]
+    return pages, questions, targets
+
+
+def hashed_encoder(dim=512):
+    # Sum of one fixed random vector per word; similar in spirit to a
+    # sentence embedding but blind to rare tokens once they are averaged in.
+    vectors = {}
+
+    def vector(token):
+        if token not in vectors:
+            vectors[token] = np.random.default_rng(zlib.crc32(token.encode())).standard_normal(dim)
+        return vectors[token]
+
+    def encode(texts):
+        return np.array([np.sum([vector(t) for t in lexical_tokens(text)] or [np.zeros(dim)], axis=0)
+                         for text in texts], dtype=np.float32)
+    return encode
+
+
+def build_index(pages, encoder):
+    index = CourseIndex()
+    per_file = -(-len(pages) // FILES)
+    start = time.perf_counter()
+    embeddings = np.concatenate([np.asarray(encoder(pages[i:i + 1000]), dtype=np.float32)
+                                 for i in range(0, len(pages), 1000)])
+    embed_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(0, len(pages), per_file):
+        index.add(f'file{i // per_file}.pdf', pages[i:i + per_file], embeddings[i:i + per_file])
+    build_time = time.perf_counter() - start
+    return index, embed_time, build_time
+
+
+def run(name, search, questions, targets, pages):
+    rows = {page: row for row, page in enumerate(pages)}
+    hits = {k: 0 for k in KS}
+    latencies = []
+    for question, target in zip(questions, targets):
+        start = time.perf_counter()
+        results = search(question, max(KS))
+        latencies.append(time.perf_counter() - start)
+        found = [rows[result['chunk']] for result in results]
+        for k in KS:
+            hits[k] += target in found[:k]
+    latencies = np.array(latencies) * 1000
+    recalls = ''.join(f'{hits[k] / len(questions):>10.3f}' for k in KS)
+    print(f'{name:<10}{recalls}{latencies.mean():>12.2f}{np.percentile(latencies, 95):>10.2f}')
+
+
+def main(chunks=20000, queries=500):
+    try:
+        encoder = get_encoder()
+        encoder_name = ENCODER_PATH
+    except Exception as e:
+        print(f'Universal Sentence Encoder unavailable ({e.__class__.__name__}), '
+              f'using a hashed bag-of-words encoder for the dense modes.')
+        encoder = hashed_encoder()
+        encoder_name = 'hashed bag-of-words'
+
+    pages, questions, targets = synthetic_course(chunks, queries)
+    index, embed_time, build_time = build_index(pages, encoder)
+    print(f'{len(pages)} chunks in {FILES} files, {len(questions)} queries, encoder: {encoder_name}')
+    print(f'embedding {embed_time:.2f}s, course index with BM25 postings {build_time:.2f}s\n')
+    print(f'{"mode":<10}' + ''.join(f'{f"recall@{k}":>10}' for k in KS) + f'{"mean ms":>12}{"p95 ms":>10}')
+
+    run('dense', lambda q, k: index.search(encoder([q]), k)[0], questions, targets, pages)
+    run('hybrid', lambda q, k: index.hybrid_search(q, encoder([q]), k), questions, targets, pages)
+    run('lexical', lambda q, k: index.lexical_search(q, k), questions, targets, pages)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -1,4 +1,3 @@
-import io
 import tkinter as tk
 from tkinter import ttk
 import tkinter.messagebox
@@ -11,8 +10,18 @@ from canvasapi import Canvas
 import re
 from bs4 import BeautifulSoup
 import hashlib
-from ai_tools import generate_answer, generate_flashcards
+from ai_tools import generate_answer, build_flashcard_deck, warm_up_encoder, refresh_course_index, \
+    background_indexer
 import threading
+import queue
+import time
+import json
+import argparse
+from types import SimpleNamespace
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
 from docx import Document
 from pptx import Presentation
 import fitz  # PyMuPDF
@@ -26,6 +35,310 @@ API_KEY = os.getenv('API_KEY')
 
 canvas = Canvas(API_URL, API_KEY)
 
+DOWNLOAD_CONCURRENCY = int(os.getenv('DOWNLOAD_CONCURRENCY', 8))
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+SYNC_MANIFEST_DIR = '.canvas_sync'
+CHAT_POLL_MS = 50
+TASK_WORKERS = int(os.getenv('TASK_WORKERS', 4))
+FLASHCARD_PAGE_SIZE = 100
+PDF_CACHE_BYTES = int(os.getenv('PDF_CACHE_BYTES', 128 * 1024 * 1024))
+PDF_PREFETCH_PAGES = 2
+PDF_POLL_MS = 20
+TREE_REFRESH_MS = int(os.getenv('TREE_REFRESH_MS', 2000))
+
+
+class ThrottledSession(requests.Session):
+    # Every request waits for the host throttle and is retried when Canvas
+    # answers with its rate-limit 403.
+    def request(self, method, url, *args, retries=3, **kwargs):
+        for attempt in range(retries + 1):
+            throttle.wait(url)
+            response = super().request(method, url, *args, **kwargs)
+            throttle.update(url, response)
+            if not is_rate_limited(response) or attempt == retries:
+                return response
+            response.close()
+            print(f"Rate limited by {urlparse(url).netloc}, retrying...")
+
+
+def size_connection_pool(session, connections):
+    # Keeps one connection per thread that can be in a request at once, so
+    # none is discarded because the pool is full.
+    for prefix in ('https://', 'http://'):
+        session.mount(prefix, HTTPAdapter(pool_connections=connections, pool_maxsize=connections))
+
+
+# One pooled, throttled session for every request, so downloads reuse TLS
+# connections instead of opening one per file. canvasapi's requester uses
+# it too, so module, page, quiz and announcement listings share the pool
+# and the throttle with the downloads.
+http_session = ThrottledSession()
+# The download jobs plus the thread listing the course
+size_connection_pool(http_session, DOWNLOAD_CONCURRENCY + 1)
+canvas._Canvas__requester._session = http_session
+
+
+class HostThrottle:
+    # Spaces out requests per host. Canvas reports the caller's remaining
+    # request quota in X-Rate-Limit-Remaining and answers 403 "Rate Limit
+    # Exceeded" once it is used up; requests slow down as the quota gets
+    # low and pause after a rate-limit response.
+    def __init__(self, min_interval=0.0, low_water=200.0, backoff=2.0):
+        self.min_interval = min_interval
+        self.low_water = low_water
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self._next_request = {}
+        self._remaining = {}
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_request.get(host, now))
+            delay = self.min_interval
+            remaining = self._remaining.get(host)
+            if remaining is not None and remaining < self.low_water:
+                delay += (self.low_water - remaining) / self.low_water
+            self._next_request[host] = start + delay
+        if start > now:
+            time.sleep(start - now)
+
+    def update(self, url, response):
+        host = urlparse(url).netloc
+        remaining = response.headers.get('X-Rate-Limit-Remaining')
+        with self._lock:
+            if remaining is not None:
+                self._remaining[host] = float(remaining)
+            if is_rate_limited(response):
+                self._next_request[host] = time.monotonic() + self.backoff
+
+
+def is_rate_limited(response):
+    return response.status_code == 403 and 'Rate Limit Exceeded' in response.text
+
+
+throttle = HostThrottle()
+
+
+class BandwidthLimiter:
+    # Token bucket shared by all downloads; consume() blocks until the
+    # bytes just read fit under bytes_per_second.
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        self._allowance = bytes_per_second
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self.rate, self._allowance + (now - self._last) * self.rate)
+            self._last = now
+            self._allowance -= size
+            delay = -self._allowance / self.rate if self._allowance < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+bandwidth_limiter = None
+
+
+def throttled_get(url, retries=3, **kwargs):
+    return http_session.get(url, retries=retries, **kwargs)
+
+
+class DownloadEngine:
+    # Runs download jobs on a bounded thread pool. Jobs may submit more
+    # jobs (a module job submits its items); wait() returns once every
+    # submitted job has finished.
+    def __init__(self, concurrency=DOWNLOAD_CONCURRENCY, limiter=None):
+        self.pool = ThreadPoolExecutor(max_workers=concurrency)
+        # An optional semaphore shared by several engines caps the number
+        # of jobs running across all of them.
+        self.limiter = limiter
+        self.completed = 0
+        self.failures = []
+        self._pending = 0
+        self._done = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, fn, *args):
+        with self._done:
+            self._pending += 1
+        future = self.pool.submit(self._run, fn, *args)
+        future.add_done_callback(self._finished)
+        return future
+
+    def _run(self, fn, *args):
+        if self.limiter is None:
+            return fn(*args)
+        with self.limiter:
+            return fn(*args)
+
+    def _finished(self, future):
+        with self._done:
+            if future.exception() is not None:
+                print(f"Download job failed. Reason: {future.exception()}")
+                self.failures.append(future.exception())
+            else:
+                self.completed += 1
+            self._pending -= 1
+            self._done.notify_all()
+
+    def wait(self):
+        with self._done:
+            while self._pending:
+                self._done.wait()
+
+    def close(self):
+        self.wait()
+        self.pool.shutdown()
+
+
+class CourseMetadata:
+    # Stands in for a canvasapi Course during a sync. The first get_file,
+    # get_page, get_quiz or get_assignment lists that kind of item for the
+    # whole course (per_page=100, page bodies included) and later lookups
+    # are served from the in-memory index, so a sync costs one request per
+    # listing page instead of one per item. Items missing from a listing,
+    # or listings the user may not access, fall back to the per-item call.
+    def __init__(self, course, per_page=100):
+        self.course = course
+        self.per_page = per_page
+        self._indexes = {}
+        self._locks = {kind: threading.Lock()
+                       for kind in ("files", "pages", "quizzes", "assignments")}
+
+    def __getattr__(self, name):
+        return getattr(self.course, name)
+
+    def _index(self, kind, list_items, key):
+        with self._locks[kind]:
+            if kind not in self._indexes:
+                try:
+                    self._indexes[kind] = {key(item): item for item in list_items()}
+                    print(f"Listed {len(self._indexes[kind])} {kind} for {self.course.name}")
+                except Exception as e:
+                    print(f"Could not list {kind}, fetching them one by one. Reason: {e}")
+                    self._indexes[kind] = {}
+            return self._indexes[kind]
+
+    def get_file(self, file_id):
+        files = self._index("files", lambda: self.course.get_files(
+            per_page=self.per_page), lambda f: f.id)
+        return files.get(file_id) or canvas.get_file(file_id)
+
+    def get_page(self, page_url):
+        pages = self._index("pages", lambda: self.course.get_pages(
+            include=["body"], per_page=self.per_page), lambda p: p.url)
+        page = pages.get(page_url)
+        if page is None or getattr(page, 'body', None) is None:
+            return self.course.get_page(page_url)
+        return page
+
+    def get_quiz(self, quiz_id):
+        quizzes = self._index("quizzes", lambda: self.course.get_quizzes(
+            per_page=self.per_page), lambda q: q.id)
+        return quizzes.get(quiz_id) or self.course.get_quiz(quiz_id)
+
+    def get_assignment(self, assignment_id):
+        assignments = self._index("assignments", lambda: self.course.get_assignments(
+            per_page=self.per_page), lambda a: a.id)
+        return assignments.get(assignment_id) or self.course.get_assignment(assignment_id)
+
+
+# Attributes that change without the content changing: read state, reply
+# counts and the caller's permissions on quizzes and announcements.
+VOLATILE_ATTRIBUTES = {
+    'read_state', 'unread_count', 'discussion_subentry_count', 'last_reply_at',
+    'subscribed', 'subscription_hold', 'user_can_see_posts', 'locked_for_user',
+    'lock_explanation', 'lock_info', 'permissions', 'can_update', 'can_unpublish',
+    'unpublishable', 'can_lock', 'can_group', 'topic_children', 'group_topic_children',
+}
+
+
+def item_version(obj):
+    # Canvas sends updated_at for files, pages and assignments. Objects
+    # without it (quizzes, announcements) are versioned by a hash of their
+    # attributes, leaving out the volatile ones so reading an announcement
+    # or a new reply doesn't trigger a download.
+    updated_at = getattr(obj, 'updated_at', None)
+    if updated_at:
+        return updated_at
+    attributes = {k: str(v) for k, v in vars(obj).items()
+                  if not k.startswith('_') and k not in VOLATILE_ATTRIBUTES
+                  and k.removesuffix('_date') not in VOLATILE_ATTRIBUTES}
+    return hashlib.sha256(json.dumps(attributes, sort_keys=True).encode()).hexdigest()
+
+
+class SyncManifest:
+    # Records the Canvas id, version, size and local path of every item
+    # downloaded for a course, so the next sync skips items that haven't
+    # changed and still exist on disk.
+    def __init__(self, path):
+        self.path = path
+        self.items = {}
+        self.fetched = 0
+        self.skipped = 0
+        self.bytes_fetched = 0
+        self.bytes_saved = 0
+        self.requests_saved = 0
+        self.failures = []
+        self._lock = threading.Lock()
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.items = json.load(f)["items"]
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Ignoring unreadable sync manifest {path}. Reason: {e}")
+
+    @classmethod
+    def for_course(cls, course):
+        return cls(os.path.join(SYNC_MANIFEST_DIR, f"{course.id}.json"))
+
+    def current_path(self, kind, item_id, version, size=None):
+        with self._lock:
+            entry = self.items.get(f"{kind}:{item_id}")
+        if (entry and entry["updated_at"] == version
+                and (size is None or entry["size"] == size)
+                and os.path.isfile(entry["path"])):
+            return entry["path"]
+        return None
+
+    def skip(self, kind, item_id, bytes_saved=0, requests_saved=0):
+        with self._lock:
+            self.skipped += 1
+            self.bytes_saved += bytes_saved
+            self.requests_saved += requests_saved
+
+    def record(self, kind, item_id, version, path, size=None):
+        with self._lock:
+            self.fetched += 1
+            self.bytes_fetched += size or 0
+            self.items[f"{kind}:{item_id}"] = {
+                "updated_at": version, "size": size, "path": path}
+
+    def fail(self, kind, item_id, reason):
+        with self._lock:
+            self.failures.append(f"{kind} {item_id}: {reason}")
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock:
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({"items": self.items}, f)
+        os.replace(self.path + '.tmp', self.path)
+
+    def summary(self):
+        return (f"{self.fetched} items fetched, {self.skipped} unchanged items skipped, "
+                f"saving {self.requests_saved} requests and {self.bytes_saved / 1e6:.1f} MB")
+
 
 def select_course(courses):
     print("Please select a course:")
@@ -44,38 +357,138 @@ def select_course(courses):
         sys.exit(1)
 
 
-def download_file(file, module_folder):
+def parse_content_range(value):
+    # "bytes 100-199/1000" -> (100, 1000); the total is None for "/*"
+    match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', value or '')
+    if not match:
+        return None
+    return int(match.group(1)), None if match.group(2) == '*' else int(match.group(2))
+
+
+def download_file(file, module_folder, progress=None):
+    # Streams the body to a ".<file id>.part" file and renames it once
+    # complete, so memory use stays constant and an interrupted download
+    # resumes on the next sync. The resume is a Range request guarded by
+    # If-Range with the ETag or Last-Modified of the first attempt, and the
+    # partial body is only kept when the server answers 206 from the same
+    # offset; anything else starts over. The part file is named after the
+    # Canvas file, so concurrent downloads of same-named files don't share it.
+    # progress(file_name, bytes_done, bytes_total, seconds) is called after
+    # every chunk; bytes_total is None when the server doesn't send a size.
     try:
-        response = requests.get(file.url, allow_redirects=True)
-        response.raise_for_status()
+        part_id = getattr(file, 'id', None) or hashlib.sha1(file.url.encode()).hexdigest()[:16]
+        partial_path = os.path.join(module_folder, f'.{part_id}.part')
+        meta_path = partial_path + '.json'
+        os.makedirs(module_folder, exist_ok=True)
 
-        content_disp = response.headers.get('content-disposition', '')
-        file_name = content_disp.split('filename=')[-1].strip('"')
-        if not file_name:
-            file_name = os.path.basename(file.url)
+        offset, meta = 0, {}
+        if os.path.isfile(partial_path) and os.path.isfile(meta_path):
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                offset = os.path.getsize(partial_path)
+            except (OSError, ValueError):
+                meta = {}
+
+        response = None
+        if offset and meta.get("validator") and meta.get("file_name"):
+            response = throttled_get(file.url, allow_redirects=True, stream=True,
+                                     headers={'Range': f'bytes={offset}-',
+                                              'If-Range': meta["validator"]})
+            content_range = parse_content_range(response.headers.get('Content-Range'))
+            if response.status_code == 416 and meta.get("total") == offset:
+                # The partial file already holds the whole body
+                response.close()
+                file_path = os.path.join(module_folder, meta["file_name"])
+                os.replace(partial_path, file_path)
+                os.remove(meta_path)
+                print(f"Downloaded {meta['file_name']} to {file_path}")
+                return file_path
+            if response.status_code == 206 and content_range and content_range[0] == offset:
+                file_name = meta["file_name"]
+            elif response.status_code == 200:
+                offset = 0  # The file changed; this is the new body from the start
+            else:
+                response.close()
+                response = None
+        if response is None:
+            offset = 0
+            response = throttled_get(file.url, allow_redirects=True, stream=True)
+        response.raise_for_status()
 
+        if offset == 0:
+            content_disp = response.headers.get('content-disposition', '')
+            file_name = content_disp.split('filename=')[-1].strip('"')
+            if not file_name:
+                file_name = os.path.basename(file.url)
         file_path = os.path.join(module_folder, file_name)
 
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        with open(file_path, 'wb') as f:
-            f.write(response.content)
-        print(f"Downloaded {file_name} to {file_path}")
+        if response.status_code == 206:
+            total = content_range[1]
+        else:
+            length = response.headers.get('Content-Length')
+            total = int(length) if length is not None else None
+            etag = response.headers.get('ETag', '')
+            validator = etag if etag and not etag.startswith('W/') else response.headers.get('Last-Modified')
+            with open(meta_path, 'w', encoding='utf-8') as f:
+                json.dump({"validator": validator, "file_name": file_name, "total": total}, f)
+
+        done = offset
+        start = time.monotonic()
+        with response, open(partial_path, 'ab' if offset else 'wb') as f:
+            for block in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(block)
+                done += len(block)
+                if bandwidth_limiter:
+                    bandwidth_limiter.consume(len(block))
+                if progress:
+                    progress(file_name, done, total, time.monotonic() - start)
+        if total is not None and done < total:
+            print(f"Incomplete download of {file_name} ({done}/{total} bytes), will resume next sync.")
+            return
+        os.replace(partial_path, file_path)
+        os.remove(meta_path)
+        elapsed = max(time.monotonic() - start, 1e-6)
+        resumed = f", resumed at {offset} bytes" if offset else ""
+        print(f"Downloaded {file_name} to {file_path} "
+              f"({(done - offset) / elapsed / 1e6:.1f} MB/s{resumed})")
+        return file_path
     except requests.exceptions.RequestException as e:
         print(f"Failed to download {file.url}. Reason: {e}")
 
 
-def download_page(course, item, path):
+def download_canvas_file(file, path, manifest=None):
+    version, size = item_version(file), getattr(file, 'size', None)
+    if manifest and manifest.current_path("file", file.id, version, size):
+        manifest.skip("file", file.id, bytes_saved=size or 0, requests_saved=1)
+        return
+    file_path = download_file(file, path)
+    if manifest and file_path:
+        manifest.record("file", file.id, version, file_path, size)
+    elif manifest:
+        manifest.fail("file", file.id, "download failed")
+
+
+def download_page(course, item, path, manifest=None):
     try:
         page = course.get_page(item.page_url)
+        version = item_version(page)
+        if manifest and manifest.current_path("page", item.page_url, version):
+            manifest.skip("page", item.page_url)
+            return
         page_title = sanitize_filename(page.title)
         page_content = clean_html(page.body)
         file_path = os.path.join(path, f"{page_title}.txt")
 
         with open(file_path, 'w', encoding='utf-8') as f:
             f.write(page_content)
+        if manifest:
+            manifest.record("page", item.page_url, version, file_path)
         print(f"Downloaded page: {page_title}")
     except Exception as e:
         print(f"Failed to download page: {item.title}. Reason: {e}")
+        if manifest:
+            manifest.fail("page", item.page_url, e)
 
 
 def handle_subheader(item, path_stack):
@@ -94,10 +507,14 @@ def handle_subheader(item, path_stack):
     print(f"Created directory for SubHeader: {item.title}")
 
 
-def download_quiz(course, item, path):
+def download_quiz(course, item, path, manifest=None):
     quiz_id = item.content_id
     try:
         quiz = course.get_quiz(quiz_id)
+        version = item_version(quiz)
+        if manifest and manifest.current_path("quiz", quiz_id, version):
+            manifest.skip("quiz", quiz_id, requests_saved=1)
+            return
         quiz_title = sanitize_filename(quiz.title)
         quiz_file_path = os.path.join(path, f"{quiz_title}.txt")
         with open(quiz_file_path, 'w') as f:
@@ -106,22 +523,35 @@ def download_quiz(course, item, path):
                 f.write(f"Question: {question.question_text}\n")
                 for answer in question.answers:
                     f.write(f"- {answer['text']}\n\n")
+        if manifest:
+            manifest.record("quiz", quiz_id, version, quiz_file_path)
         print(f"Downloaded quiz: {quiz_title}")
     except Exception as e:
         print(f"Failed to download quiz: {item.title}. Reason: {e}")
+        if manifest:
+            manifest.fail("quiz", quiz_id, e)
 
 
-def download_assignment(course, item, path):
+def download_assignment(course, item, path, manifest=None):
     assignment_id = item.content_id
     try:
         assignment = course.get_assignment(assignment_id)
+        version = item_version(assignment)
+        if manifest and manifest.current_path("assignment", assignment_id, version):
+            manifest.skip("assignment", assignment_id)
+            return
         assignment_content = clean_html(assignment.description)
         valid_file_name = sanitize_filename(assignment.name)
-        with open(os.path.join(path, f"{valid_file_name}.txt"), 'w') as f:
+        file_path = os.path.join(path, f"{valid_file_name}.txt")
+        with open(file_path, 'w') as f:
             f.write(assignment_content)
+        if manifest:
+            manifest.record("assignment", assignment_id, version, file_path)
         print(f"Downloaded assignment: {assignment.name}")
     except Exception as e:
         print(f"Failed to download assignment: {item.title}. Reason: {e}")
+        if manifest:
+            manifest.fail("assignment", assignment_id, e)
 
 
 def clean_html(html_content):
@@ -169,182 +599,613 @@ def save_external_url(item, path):
             f"Failed to save external URL '{external_url_title}'. Reason: {e}")
 
 
-def download_announcements(course, course_folder):
+def download_announcements(course, course_folder, manifest=None):
     announcements_folder = os.path.join(course_folder, "Announcements")
     # Ensure the folder exists
     os.makedirs(announcements_folder, exist_ok=True)
     try:
         announcements = course.get_discussion_topics(only_announcements=True)
         for announcement in announcements:
+            version = item_version(announcement)
+            announcement_id = getattr(announcement, 'id', announcement.title)
+            if manifest and manifest.current_path("announcement", announcement_id, version):
+                manifest.skip("announcement", announcement_id)
+                continue
             title = sanitize_filename(announcement.title)
             message = clean_html(announcement.message)
             announcement_path = os.path.join(
                 announcements_folder, f"{title}.txt")
             with open(announcement_path, 'w', encoding='utf-8') as f:
                 f.write(message)
+            if manifest:
+                manifest.record("announcement", announcement_id, version, announcement_path)
             print(f"Downloaded announcement: {title}")
     except Exception as e:
         print(f"Failed to download announcements. Reason: {e}")
+        if manifest:
+            manifest.fail("announcements", course.id, e)
+
+
+def download_file_item(course, module_item, path, manifest=None):
+    file = course.get_file(module_item.content_id)
+    download_canvas_file(file, path, manifest)
+
+
+def download_module(course, module, course_folder, engine, manifest=None):
+    module_name = module.name
+    print(f"\nDownloading module: {module_name}")
+
+    module_folder = os.path.join(
+        course_folder, sanitize_filename(module_name))
+    os.makedirs(module_folder, exist_ok=True)
+    # Initialize the stack with the module folder
+    path_stack = [module_folder]
+
+    # Items are walked in order so SubHeaders build the same folders as
+    # before; only the downloads themselves run concurrently.
+    for module_item in module.get_module_items(per_page=100):
+        if module_item.type == "File":
+            engine.submit(download_file_item, course, module_item,
+                          path_stack[-1], manifest)
+        elif module_item.type == "Page":
+            engine.submit(download_page, course, module_item,
+                          path_stack[-1], manifest)
+        elif module_item.type == "Quiz":
+            engine.submit(download_quiz, course, module_item,
+                          path_stack[-1], manifest)
+        elif module_item.type == "Assignment":
+            engine.submit(download_assignment, course, module_item,
+                          path_stack[-1], manifest)
+        elif module_item.type == "ExternalUrl":
+            save_external_url(module_item, path_stack[-1])
+        elif module_item.type == "SubHeader":
+
+            handle_subheader(module_item, path_stack)
+        else:
+            print(f"Item type {module_item.type} not handled.")
+
+
+def list_json(url, per_page=100):
+    # Yields every entry of a paginated Canvas listing, following the
+    # rel="next" Link header until the last page.
+    headers = {'Authorization': 'Bearer {}'.format(API_KEY)}
+    params = {'per_page': per_page}
+    while url:
+        response = throttled_get(url, headers=headers, params=params)
+        # This will raise an HTTPError if the HTTP request returned an unsuccessful status code
+        response.raise_for_status()
+        yield from response.json()
+        url = response.links.get('next', {}).get('url')
+        params = None  # The next link already carries the query
+
+
+def report_folder_error(folder, url, e):
+    if isinstance(e, requests.exceptions.HTTPError):
+        # Here we catch HTTP errors, which include the 403 Forbidden
+        print(
+            f"HTTP Request failed: {e.response.status_code} {e.response.reason} for url: {url}")
+        if e.response.status_code == 403:
+            print(
+                "It looks like we don't have access to this resource. Skipping...")
+    elif isinstance(e, requests.exceptions.RequestException):
+        # This catches any other exceptions that requests might raise
+        print(
+            f"Failed to get files in folder: {folder['name']}. Reason: {e}")
+    else:
+        # This will catch any other exceptions
+        print(f"An unexpected error occurred: {e}")
 
 
-def print_and_download_course_details(course):
+def crawl_folder(folder, current_path, engine, manifest=None, recurse=True):
+    os.makedirs(current_path, exist_ok=True)
+    folder_files_url = f"{API_URL}/api/v1/folders/{folder['id']}/files"
+    try:
+        for file_data in list_json(folder_files_url):
+            # The listing already has everything a download needs
+            engine.submit(download_canvas_file, SimpleNamespace(**file_data),
+                          current_path, manifest)
+    except Exception as e:
+        report_folder_error(folder, folder_files_url, e)
+    if not recurse:
+        return
+    subfolders_url = f"{API_URL}/api/v1/folders/{folder['id']}/folders"
+    try:
+        for subfolder in list_json(subfolders_url):
+            new_path = os.path.join(current_path, sanitize_filename(subfolder['name']))
+            engine.submit(crawl_folder, subfolder, new_path, engine, manifest)
+    except Exception as e:
+        report_folder_error(folder, subfolders_url, e)
+
+
+def crawl_course_files(course, course_folder, engine, manifest=None, whole_tree=True):
+    # Downloads the course's file tree. With whole_tree the complete folder
+    # list comes from one paginated /courses/:id/folders listing and the
+    # tree is rebuilt locally, so every folder's file listing can start at
+    # once. Otherwise, or if that listing is not accessible, folders are
+    # crawled breadth-first, each one queueing its subfolders on the engine.
+    # Returns False when the course has no root folder.
+    folders = None
+    if whole_tree:
+        try:
+            folders = list(list_json(f"{API_URL}/api/v1/courses/{course.id}/folders"))
+        except requests.exceptions.RequestException as e:
+            print(f"Could not list course folders, crawling them instead. Reason: {e}")
+
+    if folders is None:
+        root_folder = None
+        for folder in course.get_folders():
+            if folder.parent_folder_id is None:
+                root_folder = {"id": folder.id, "name": folder.name}
+                break
+        if root_folder is None:
+            return False
+        root_path = os.path.join(course_folder, sanitize_filename(root_folder['name']))
+        engine.submit(crawl_folder, root_folder, root_path, engine, manifest)
+        return True
+
+    children = {}
+    root_folder = None
+    for folder in folders:
+        if folder.get('parent_folder_id') is None:
+            root_folder = folder
+        else:
+            children.setdefault(folder['parent_folder_id'], []).append(folder)
+    if root_folder is None:
+        return False
+    pending = [(root_folder, os.path.join(course_folder, sanitize_filename(root_folder['name'])))]
+    for folder, path in pending:
+        engine.submit(crawl_folder, folder, path, engine, manifest, False)
+        for child in children.get(folder['id'], []):
+            pending.append((child, os.path.join(path, sanitize_filename(child['name']))))
+    return True
+
+
+def print_and_download_course_details(course, engine=None, manifest=None):
     course_name = course.name
     course_folder = os.path.join(os.getcwd(), sanitize_filename(course_name))
     os.makedirs(course_folder, exist_ok=True)
 
     print(f"\nCourse Name: {course_name}")
     print(f"Course Code: {course.course_code}\n")
-    download_announcements(course, course_folder)
-
-    modules = course.get_modules()
+    own_engine = engine is None
+    if own_engine:
+        engine = DownloadEngine()
+    if manifest is None:
+        manifest = SyncManifest.for_course(course)
+    course = CourseMetadata(course)
+    engine.submit(download_announcements, course, course_folder, manifest)
+
+    modules = course.get_modules(per_page=100)
     if not list(modules):
         print("No modules found.")
-        # Get the root files folder
-        root_folder = None
-        for folder in course.get_folders():
-            if folder.parent_folder_id is None:
-                root_folder = folder
-                break
-
-        if root_folder:
-            # Use the Canvas API to explore folder hierarchy
-
-            def get_files_in_folder_recursive(folder, current_path):
-                folder_files_url = f"{API_URL}/api/v1/folders/{folder.id}/files"
-                try:
-                    file_response = requests.get(folder_files_url, headers={
-                                                 'Authorization': 'Bearer {}'.format(API_KEY)})
-                    # This will raise an HTTPError if the HTTP request returned an unsuccessful status code
-                    file_response.raise_for_status()
-                    files_json = file_response.json()
-
-                    for file_data in files_json:
-                        file_obj = canvas.get_file(file_data['id'])
-                        download_file(file_obj, current_path)
-
-                    subfolders = folder.get_folders()
-                    for subfolder in subfolders:
-                        subfolder_name = sanitize_filename(subfolder.name)
-                        new_path = os.path.join(current_path, subfolder_name)
-                        os.makedirs(new_path, exist_ok=True)
-                        get_files_in_folder_recursive(subfolder, new_path)
-
-                except requests.exceptions.HTTPError as e:
-                    # Here we catch HTTP errors, which include the 403 Forbidden
-                    print(
-                        f"HTTP Request failed: {e.response.status_code} {e.response.reason} for url: {folder_files_url}")
-                    if e.response.status_code == 403:
-                        print(
-                            "It looks like we don't have access to this resource. Skipping...")
-                except requests.exceptions.RequestException as e:
-                    # This catches any other exceptions that requests might raise
-                    print(
-                        f"Failed to get files in folder: {folder.name}. Reason: {e}")
-                except Exception as e:
-                    # This will catch any other exceptions
-                    print(f"An unexpected error occurred: {e}")
-
-            # Start recursive file and folder download process
-            root_folder_name = sanitize_filename(root_folder.name)
-            root_folder_path = os.path.join(course_folder, root_folder_name)
-            os.makedirs(root_folder_path, exist_ok=True)
-            try:
-                get_files_in_folder_recursive(root_folder, root_folder_path)
-            except Exception as e:
-                print(f"Failed to download files. Reason: {e}")
-
-        else:
+        if not crawl_course_files(course, course_folder, engine, manifest):
             print("Root folder not found, downloading files from course root.")
-            for file in course.get_files():
-                download_file(file, course_folder)
+            for file in course.get_files(per_page=100):
+                engine.submit(download_canvas_file, file, course_folder, manifest)
     else:
         print(f"Downloading modules for course: {course_name}")
         for module in modules:
-            module_name = module.name
-            print(f"\nDownloading module: {module_name}")
-
-            module_folder = os.path.join(
-                course_folder, sanitize_filename(module_name))
-            os.makedirs(module_folder, exist_ok=True)
-            # Initialize the stack with the module folder
-            path_stack = [module_folder]
-
-            for module_item in module.get_module_items():
-                if module_item.type == "File":
-                    file = canvas.get_file(module_item.content_id)
-                    download_file(file, path_stack[-1])
-                elif module_item.type == "Page":
-                    download_page(course, module_item, path_stack[-1])
-                elif module_item.type == "Quiz":
-                    download_quiz(course, module_item, path_stack[-1])
-                elif module_item.type == "Assignment":
-                    download_assignment(course, module_item, path_stack[-1])
-                elif module_item.type == "ExternalUrl":
-                    save_external_url(module_item, path_stack[-1])
-                elif module_item.type == "SubHeader":
-
-                    handle_subheader(module_item, path_stack)
-                else:
-                    print(f"Item type {module_item.type} not handled.")
-
-            # Reset the path_stack for the next module
-            path_stack = [module_folder]
+            engine.submit(download_module, course, module,
+                          course_folder, engine, manifest)
+    if own_engine:
+        engine.close()
+    else:
+        engine.wait()
+    manifest.save()
+    print(f"Sync of {course_name}: {manifest.summary()}")
     return course_folder
 
 
-def flashcardGUI(flashcards: dict):
+def course_matches(course, filters):
+    if not filters:
+        return True
+    return any(f == str(course.id) or f.lower() in course.name.lower()
+               or f.lower() in course.course_code.lower() for f in filters)
+
+
+def mirror_courses(courses, filters=None, course_workers=2,
+                   concurrency=DOWNLOAD_CONCURRENCY, max_bandwidth=None):
+    # Headless mirror of every course matching `filters` (ids or parts of
+    # names/codes). Up to course_workers courses sync at once, each with its
+    # own download engine; a shared semaphore caps jobs across all of them
+    # at `concurrency` and max_bandwidth (bytes/s) caps total throughput.
+    global bandwidth_limiter
+    if max_bandwidth:
+        bandwidth_limiter = BandwidthLimiter(max_bandwidth)
+    selected = []
+    for course in courses:
+        try:
+            if course_matches(course, filters):
+                selected.append(course)
+        except AttributeError:
+            print(f"Skipping course {getattr(course, 'id', '?')} without a name or code.")
+    print(f"Mirroring {len(selected)} courses with {course_workers} course workers "
+          f"and {concurrency} concurrent downloads.")
+
+    limiter = threading.Semaphore(concurrency)
+    # Each course worker lists its course while up to `concurrency` jobs
+    # download across all of them
+    size_connection_pool(http_session, concurrency + course_workers)
+
+    def mirror(course):
+        start = time.monotonic()
+        manifest = SyncManifest.for_course(course)
+        error = None
+        with DownloadEngine(concurrency, limiter=limiter) as engine:
+            try:
+                print_and_download_course_details(course, engine, manifest)
+            except Exception as e:
+                error = e
+        if error is not None:
+            manifest.fail("course", course.id, error)
+        return {"course": course.name, "seconds": time.monotonic() - start,
+                "fetched": manifest.fetched, "skipped": manifest.skipped,
+                "bytes": manifest.bytes_fetched, "failures": manifest.failures}
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=course_workers) as pool:
+        results = list(pool.map(mirror, selected))
+    elapsed = max(time.monotonic() - start, 1e-6)
+
+    print("\nMirror report")
+    for result in results:
+        seconds = max(result["seconds"], 1e-6)
+        print(f"  {result['course']}: {result['fetched']} fetched, {result['skipped']} unchanged, "
+              f"{result['bytes'] / 1e6:.1f} MB in {seconds:.1f}s "
+              f"({result['bytes'] / seconds / 1e6:.2f} MB/s, {result['fetched'] / seconds:.1f} items/s), "
+              f"{len(result['failures'])} failures")
+        for failure in result["failures"]:
+            print(f"    failed {failure}")
+    total_bytes = sum(r["bytes"] for r in results)
+    total_items = sum(r["fetched"] for r in results)
+    total_failures = sum(len(r["failures"]) for r in results)
+    print(f"  Total: {len(results)} courses, {total_items} items, {total_bytes / 1e6:.1f} MB in {elapsed:.1f}s "
+          f"({total_bytes / elapsed / 1e6:.2f} MB/s, {total_items / elapsed:.1f} items/s), "
+          f"{total_failures} failures")
+    return results
+
+
+def flashcardGUI(deck):
     class FlashcardsApp(tk.Tk):
-        def __init__(self, flashcard_data):
+        def __init__(self, deck):
             super().__init__()
 
-            self.flashcards = flashcard_data["flashcards"]
+            # Cards are read from the deck store a page at a time, so large
+            # decks open without loading every card.
+            self.deck = deck
+            self.total_cards = len(deck)
+            self.page_start = 0
+            self.page = []
             self.current_card = 0
 
             self.title("Flashcards")
             self.geometry("800x400")
 
-            self.question_label = tk.Label(self, text=self.flashcards[self.current_card]["question"],
+            question = self.card(0)["question"] if self.total_cards else "No flashcards for this selection."
+            self.question_label = tk.Label(self, text=question,
                                            font=("Arial", 20, "bold"), wraplength=700)
             self.question_label.pack(pady=50)
 
             self.show_answer_button = tk.Button(self, text="Show Answer",
-                                                command=self.show_answer, font=("Arial", 15))
+                                                command=self.show_answer, font=("Arial", 15),
+                                                state="normal" if self.total_cards else "disabled")
             self.show_answer_button.pack()
 
             self.next_button = tk.Button(self, text="Next", command=self.next_card,
                                          font=("Arial", 15), state="disabled")
             self.next_button.pack(pady=20)
 
+        def card(self, index):
+            if not self.page_start <= index < self.page_start + len(self.page):
+                self.page_start = index - index % FLASHCARD_PAGE_SIZE
+                self.page = self.deck.page(self.page_start, FLASHCARD_PAGE_SIZE)
+            return self.page[index - self.page_start]
+
         def show_answer(self):
             self.show_answer_button.config(state="disabled")
 
-            self.answer_label = tk.Label(self, text=self.flashcards[self.current_card]["answer"],
+            self.answer_label = tk.Label(self, text=self.card(self.current_card)["answer"],
                                          font=("Arial", 15), wraplength=700)
             self.answer_label.pack(pady=10)
 
-            if self.current_card < len(self.flashcards) - 1:
+            if self.current_card < self.total_cards - 1:
                 self.next_button.config(state="normal")
 
         def next_card(self):
             self.current_card += 1
             self.question_label.config(
-                text=self.flashcards[self.current_card]["question"])
+                text=self.card(self.current_card)["question"])
             self.answer_label.destroy()
 
             self.show_answer_button.config(state="normal")
             self.next_button.config(state="disabled")
 
-    app = FlashcardsApp(flashcards)
+    app = FlashcardsApp(deck)
     app.mainloop()
 
 
+class PageCache:
+    # LRU of rendered PDF pages keyed by (file, page, zoom), bounded by the
+    # size of the decoded images.
+    def __init__(self, max_bytes=PDF_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._pages = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def image_bytes(image):
+        return image.width * image.height * len(image.getbands())
+
+    def get(self, key):
+        with self._lock:
+            image = self._pages.get(key)
+            if image is not None:
+                self._pages.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        with self._lock:
+            old = self._pages.pop(key, None)
+            if old is not None:
+                self._bytes -= self.image_bytes(old)
+            self._pages[key] = image
+            self._bytes += self.image_bytes(image)
+            while self._bytes > self.max_bytes and len(self._pages) > 1:
+                _, evicted = self._pages.popitem(last=False)
+                self._bytes -= self.image_bytes(evicted)
+
+
+pdf_page_cache = PageCache()
+# fitz documents aren't thread safe, so every page is rendered on one thread
+pdf_render_executor = ThreadPoolExecutor(max_workers=1)
+
+
+class PdfViewer(ttk.Frame):
+    # Shows one page at a time. Pages are rendered on the render thread,
+    # the neighbouring ones ahead of time, and only the visible page is
+    # kept as a Tk image.
+    def __init__(self, master, file_path, zoom=1.0):
+        super().__init__(master)
+        self.file_path = file_path
+        self.doc = fitz.open(file_path)
+        self.page_count = len(self.doc)
+        self.page_num = 0
+        self.zoom = zoom
+        self.photo = None
+        self._pending = {}
+        self._failed = {}
+        self._draw_job = None
+
+        toolbar = ttk.Frame(self)
+        toolbar.pack(side="top", fill="x")
+        ttk.Button(toolbar, text="◀", command=lambda: self.show_page(self.page_num - 1)).pack(side="left")
+        ttk.Button(toolbar, text="▶", command=lambda: self.show_page(self.page_num + 1)).pack(side="left")
+        ttk.Button(toolbar, text="−", command=lambda: self.set_zoom(self.zoom / 1.25)).pack(side="left")
+        ttk.Button(toolbar, text="+", command=lambda: self.set_zoom(self.zoom * 1.25)).pack(side="left")
+        self.page_label = ttk.Label(toolbar)
+        self.page_label.pack(side="left", padx=10)
+
+        self.canvas = tk.Canvas(self)
+        scroll_y = ttk.Scrollbar(self, orient="vertical", command=self.canvas.yview)
+        scroll_x = ttk.Scrollbar(self, orient="horizontal", command=self.canvas.xview)
+        self.canvas.configure(yscrollcommand=scroll_y.set, xscrollcommand=scroll_x.set)
+        scroll_y.pack(side="right", fill="y")
+        scroll_x.pack(side="bottom", fill="x")
+        self.canvas.pack(expand=True, fill="both")
+        self.canvas.bind("<Button-1>", lambda event: self.canvas.focus_set())
+        self.canvas.bind("<Next>", lambda event: self.show_page(self.page_num + 1))
+        self.canvas.bind("<Prior>", lambda event: self.show_page(self.page_num - 1))
+        self.bind("<Destroy>", self.on_destroy)
+
+        self.show_page(0)
+
+    def key(self, page_num):
+        return (self.file_path, page_num, round(self.zoom, 3))
+
+    def render(self, key):
+        # Runs on the render thread. Prefetches the user has already paged
+        # away from are dropped.
+        _, page_num, zoom = key
+        if self.doc is None or abs(page_num - self.page_num) > PDF_PREFETCH_PAGES:
+            return None
+        image = pdf_page_cache.get(key)
+        if image is None:
+            pix = self.doc.load_page(page_num).get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+            pdf_page_cache.put(key, image)
+        return image
+
+    def request(self, page_num):
+        key = self.key(page_num)
+        if key in self._pending or key in self._failed or pdf_page_cache.get(key) is not None:
+            return
+        future = pdf_render_executor.submit(self.render, key)
+        self._pending[key] = future
+        future.add_done_callback(lambda future: self.rendered(key, future))
+
+    def rendered(self, key, future):
+        # Runs on the render thread. A page that failed to render is not
+        # tried again, draw shows the error instead.
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Failed to render page {key[1] + 1} of {self.file_path}. Reason: {future.exception()}")
+            self._failed[key] = future.exception()
+        self._pending.pop(key, None)
+
+    def show_page(self, page_num):
+        if not 0 <= page_num < self.page_count:
+            return
+        self.page_num = page_num
+        self.page_label.config(text=f"Page {page_num + 1} / {self.page_count}")
+        self.request(page_num)
+        for offset in range(1, PDF_PREFETCH_PAGES + 1):
+            for neighbour in (page_num + offset, page_num - offset):
+                if 0 <= neighbour < self.page_count:
+                    self.request(neighbour)
+        if self._draw_job is not None:
+            self.after_cancel(self._draw_job)
+            self._draw_job = None
+        self.draw()
+
+    def draw(self):
+        # Polls until the visible page has been rendered or has failed
+        self._draw_job = None
+        if self.doc is None:
+            return
+        key = self.key(self.page_num)
+        image = pdf_page_cache.get(key)
+        if key in self._failed:
+            self.photo = None
+            self.canvas.delete("all")
+            self.canvas.create_text(20, 20, anchor="nw", fill="red",
+                                    text=f"Could not render page {self.page_num + 1}: {self._failed[key]}")
+            self.canvas.configure(scrollregion=(0, 0, 0, 0))
+            return
+        if image is None:
+            self.request(self.page_num)
+            self._draw_job = self.after(PDF_POLL_MS, self.draw)
+            return
+        self.photo = ImageTk.PhotoImage(image)
+        self.canvas.delete("all")
+        self.canvas.create_image(0, 0, image=self.photo, anchor="nw")
+        self.canvas.configure(scrollregion=(0, 0, image.width, image.height))
+
+    def set_zoom(self, zoom):
+        self.zoom = min(max(zoom, 0.25), 4.0)
+        self.show_page(self.page_num)
+
+    def on_destroy(self, event):
+        if event.widget is self and self.doc is not None:
+            doc, self.doc = self.doc, None
+            # Closed on the render thread, after any render still using it
+            pdf_render_executor.submit(doc.close)
+
+
+class Task:
+    # Handle passed to a job; progress and UI updates it posts are dropped
+    # once the task is cancelled.
+    def __init__(self, executor, name):
+        self.executor = executor
+        self.name = name
+        self.future = None
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def progress(self, text):
+        self.post(self.executor.set_progress, self, text)
+
+    def post(self, callback, *args):
+        # callback(*args) runs on the Tk thread
+        self.executor.events.put((self, callback, args))
+
+
+class TaskExecutor:
+    # Runs retrieval, LLM and flashcard jobs on a bounded pool. Jobs never
+    # touch widgets; their results, progress and UI updates go through a
+    # queue the Tk thread drains with after().
+    def __init__(self, root, workers=TASK_WORKERS, on_status=None):
+        self.root = root
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.events = queue.Queue()
+        self.tasks = {}
+        self.status = {}
+        self.on_status = on_status
+        self.root.after(CHAT_POLL_MS, self.drain)
+
+    def submit(self, name, fn, *args, on_done=None, on_error=None, supersede=True):
+        # Runs fn(task, *args) on the pool, then on_done(result) or
+        # on_error(exception) on the Tk thread. With supersede, a running
+        # task of the same name is cancelled first.
+        if supersede:
+            self.cancel(name)
+        task = Task(self, name)
+        self.tasks[name] = task
+        self.set_progress(task, "queued")
+        task.future = self.pool.submit(self._run, task, fn, args, on_done, on_error)
+        return task
+
+    def _run(self, task, fn, args, on_done, on_error):
+        try:
+            result = fn(task, *args)
+            if on_done is not None:
+                task.post(on_done, result)
+        except Exception as e:
+            print(f"Task {task.name} failed: {e}")
+            if on_error is not None:
+                task.post(on_error, e)
+        finally:
+            self.events.put((None, self.finish, (task,)))
+
+    def cancel(self, name):
+        # Cancels the task only if it is still running; the updates of one
+        # that has already finished are applied first, so its output isn't
+        # cut short. Returns whether a running task was cancelled.
+        self.process_events()
+        task = self.tasks.get(name)
+        if task is None:
+            return False
+        if task.future is not None and task.future.done():
+            self.process_events()
+            return False
+        task.cancel()
+        self.finish(task)
+        return True
+
+    def set_progress(self, task, text):
+        self.status[task] = f"{task.name}: {text}"
+        self.update_status()
+
+    def finish(self, task):
+        self.status.pop(task, None)
+        if self.tasks.get(task.name) is task:
+            del self.tasks[task.name]
+        self.update_status()
+
+    def update_status(self):
+        if self.on_status is not None:
+            self.on_status(" | ".join(self.status.values()))
+
+    def drain(self):
+        # Rescheduled first so a callback that runs its own mainloop (the
+        # flashcard window) doesn't stop the queue.
+        self.root.after(CHAT_POLL_MS, self.drain)
+        self.process_events()
+
+    def process_events(self):
+        try:
+            while True:
+                task, callback, args = self.events.get_nowait()
+                if task is not None and task.cancelled:
+                    continue
+                try:
+                    callback(*args)
+                except Exception as e:
+                    print(f"UI update failed: {e}")
+        except queue.Empty:
+            pass
+
+
 class CourseApp(tk.Tk):
     def __init__(self, course_folder, context=""):
         super().__init__()
         self.context = context
         self.course_folder = course_folder
         self.open_tabs = {}
+        # Tree node id -> absolute path, and mtime of every listed directory
+        self.node_paths = {}
+        self.dir_mtimes = {}
         self.image = "snips/snip.png"  # Attribute to store the image path
+        # Load the sentence encoder while the user picks files instead of
+        # on the first question.
+        warm_up_encoder()
 
         self.title("Quercus Assistant")
         self.geometry("1920x1080")
@@ -352,6 +1213,10 @@ class CourseApp(tk.Tk):
         self.create_widgets()
         self.update_treeview(self.course_folder)
 
+        self.stream_tag = None
+        self.tasks = TaskExecutor(self, on_status=self.show_status)
+        self.after(TREE_REFRESH_MS, self.refresh_treeview)
+
     def create_widgets(self):
         self.notebook = ttk.Notebook(self)
         self.create_main_frame()
@@ -387,6 +1252,8 @@ class CourseApp(tk.Tk):
         self.chat_input.bind("<Return>", self.chat_send_event)
         # Bind double-click event
         self.treeview.bind("<Double-1>", self.on_file_double_click)
+        self.treeview.bind("<<TreeviewOpen>>", self.on_tree_open)
+        self.treeview.bind("<<TreeviewSelect>>", self.on_tree_select)
 
         self.chat_send_button = ttk.Button(
             main_frame, text="Send", command=self.send_chat)
@@ -399,6 +1266,9 @@ class CourseApp(tk.Tk):
         self.chat_image_label = tk.Label(main_frame)
         self.chat_image_label.grid(row=2, column=2, padx=(10, 0), sticky="ew")
 
+        self.status_label = ttk.Label(main_frame, anchor="w")
+        self.status_label.grid(row=1, column=0, sticky="ew")
+
         self.notebook.add(main_frame, text="Main")
         self.snip_button = ttk.Button(self, text="Snip", command=self.snip)
         self.snip_button.place(relx=1.0, rely=0.0, anchor='ne')
@@ -412,25 +1282,33 @@ class CourseApp(tk.Tk):
         self.update_chat_image("snips/snip.png")
 
     def createFlashcards(self):
-        if not self.treeview.selection():
+        complete_paths = self.selected_paths()
+        if not complete_paths:
             tkinter.messagebox.showinfo(
                 "Info", "Please select files from the treeview.")
             return
-        complete_paths = []
-        for file_item in self.treeview.selection():
-            complete_paths.append(os.path.join(
-                self.course_folder, self.get_filepath(file_item, self.course_folder)))
-        tkinter.messagebox.showinfo(
-            "Info", "Generating flashcards. Please wait...")
-        flashcard_dict = generate_flashcards(
-            complete_paths, self.context)
-
-        # Call the flashcardGUI function with the flashcard_dict
-        flashcardGUI(flashcard_dict)
+
+        # Call the flashcardGUI function with the deck once it is built
+        self.tasks.submit("flashcards", self.build_deck, complete_paths,
+                          on_done=flashcardGUI, on_error=self.show_task_error, supersede=False)
 
         # self.send_response("bot", bot_response)
 
-    def send_response(self, response_type, message):
+    def build_deck(self, task, complete_paths):
+        return build_flashcard_deck(complete_paths, self.context, progress=task.progress)
+
+    def show_status(self, text):
+        self.status_label.config(text=text)
+
+    def show_task_error(self, error):
+        self.send_response("system", f"Error: {error}")
+
+    def show_chat_error(self, error):
+        # Only the chat task owns the answer being streamed
+        self.end_stream(" [failed]")
+        self.show_task_error(error)
+
+    def configure_chat_tag(self, response_type):
         color_map = {
             "user": "green",
             "bot": "white",
@@ -444,15 +1322,30 @@ class CourseApp(tk.Tk):
 
         self.chat_text.tag_configure(
             response_type, foreground=color_map[response_type], font=font_map[response_type])
+
+    def send_response(self, response_type, message):
+        self.configure_chat_tag(response_type)
         self.chat_text.insert(
             "end", f"{response_type.upper()}: {message}\n", response_type)
 
+    def start_stream(self, response_type):
+        self.stream_tag = response_type
+        self.configure_chat_tag(response_type)
+        self.chat_text.insert("end", f"{response_type.upper()}: ", response_type)
+        self.chat_text.see("end")
+
+    def append_stream(self, text):
+        self.chat_text.insert("end", text, self.stream_tag)
+        self.chat_text.see("end")
+
+    def end_stream(self, suffix=""):
+        if self.stream_tag is not None:
+            self.chat_text.insert("end", f"{suffix}\n", self.stream_tag)
+            self.stream_tag = None
+
     def get_filepath(self, tree_item, base_folder):
-        parent = self.treeview.parent(tree_item)
-        if parent:
-            return os.path.join(self.get_filepath(parent, base_folder), self.treeview.item(tree_item, option="text"))
-        else:
-            return self.treeview.item(tree_item, option="text")
+        # Absolute, so joining it onto base_folder leaves it unchanged
+        return self.node_paths.get(tree_item, "")
 
     def chat_send_event(self, event):
         self.send_chat()
@@ -467,6 +1360,9 @@ class CourseApp(tk.Tk):
         if self.image:
             display_message += f"\n[Image: {self.image}]"
 
+        # A new question supersedes the answer still being written
+        if self.tasks.cancel("chat"):
+            self.end_stream(" [stopped]")
         self.send_response("user", display_message)
         self.chat_input.delete(0, "end")
 
@@ -477,8 +1373,13 @@ class CourseApp(tk.Tk):
         self.chat_text.see("end")
         self.update_idletasks()
 
-        threading.Thread(target=self.generate_response,
-                         args=(chat_message, "snips/snip.png")).start()
+        # Read the selection here, Tk widgets are not safe to use from the
+        # worker thread.
+        complete_paths = self.selected_paths()
+
+        background_indexer.prioritize(complete_paths)
+        self.tasks.submit("chat", self.generate_response, chat_message, complete_paths,
+                          "snips/snip.png", on_error=self.show_chat_error)
 
     def clear_chat_image(self):
         """ Clear the chat image """
@@ -493,32 +1394,102 @@ class CourseApp(tk.Tk):
         else:
             print("Image file does not exist.")
 
-    def generate_response(self, chat_message, image=None):
-        # Get complete paths of selected files
-        complete_paths = []
-        for file_item in self.treeview.selection():
-            complete_paths.append(os.path.join(
-                self.course_folder, self.get_filepath(file_item, self.course_folder)))
-
-        bot_response = generate_answer(
-            chat_message, complete_paths, self.context, image=image)
-        self.send_response("bot", bot_response)
-
-    def insert_files_recursively(self, folder, root_node):
-        for item in os.listdir(folder):
-            item_path = os.path.join(folder, item)
-            if os.path.isdir(item_path):
-                directory_node = self.treeview.insert(
-                    root_node, "end", text=item, open=True,
-                )
-                self.insert_files_recursively(item_path, directory_node)
-            else:
-                self.treeview.insert(root_node, "end", text=item)
+    def generate_response(self, task, chat_message, complete_paths, image=None):
+        start = time.perf_counter()
+        task.progress("searching course material")
+        tokens = generate_answer(
+            chat_message, complete_paths, self.context, image=image, stream=True)
+        task.progress("waiting for the answer")
+        task.post(self.start_stream, "bot")
+        first_token = None
+        for count, token in enumerate(tokens, 1):
+            if task.cancelled:
+                tokens.close()
+                print(f"Answer superseded after {time.perf_counter() - start:.2f}s")
+                return
+            if first_token is None:
+                first_token = time.perf_counter() - start
+                print(f"First token after {first_token:.2f}s")
+            task.post(self.append_stream, token)
+            if count % 25 == 0:
+                task.progress(f"{count} chunks received")
+        task.post(self.end_stream)
+        print(f"Answer finished after {time.perf_counter() - start:.2f}s")
+
+    def node_folder(self, node):
+        return self.course_folder if node == "" else self.node_paths[node]
+
+    def insert_entry(self, parent_node, entry):
+        node = self.treeview.insert(parent_node, "end", text=entry.name)
+        self.node_paths[node] = entry.path
+        if entry.is_dir():
+            # Placeholder so the folder can be expanded before it is listed
+            self.treeview.insert(node, "end", text="...")
+
+    def insert_children(self, node):
+        # Lists one folder; its subfolders are listed when they are opened.
+        folder = self.node_folder(node)
+        self.treeview.delete(*self.treeview.get_children(node))
+        self.dir_mtimes[node] = os.stat(folder).st_mtime_ns
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                self.insert_entry(node, entry)
+
+    def forget_node(self, node):
+        for child in self.treeview.get_children(node):
+            self.forget_node(child)
+        self.node_paths.pop(node, None)
+        self.dir_mtimes.pop(node, None)
+        if node:
+            self.treeview.delete(node)
+
+    def on_tree_open(self, event):
+        node = self.treeview.focus()
+        if node in self.node_paths and node not in self.dir_mtimes:
+            self.insert_children(node)
+
+    def selected_paths(self):
+        # Placeholder ("...") nodes have no path and are left out
+        return [self.node_paths[item] for item in self.treeview.selection()
+                if item in self.node_paths]
+
+    def on_tree_select(self, event):
+        # Placeholders can't stay selected; removing them fires this again
+        placeholders = [item for item in self.treeview.selection() if item not in self.node_paths]
+        if placeholders:
+            self.treeview.selection_remove(*placeholders)
+            return
+        # Start embedding the selected files while the question is typed
+        background_indexer.select(self.selected_paths())
+
+    def refresh_treeview(self):
+        # No watchdog here, so listed folders are polled instead: a changed
+        # mtime means entries were added, removed or renamed, and only that
+        # folder is listed again.
+        for node, mtime in list(self.dir_mtimes.items()):
+            if node not in self.dir_mtimes:
+                continue  # Its parent was removed earlier in this pass
+            try:
+                current = os.stat(self.node_folder(node)).st_mtime_ns
+            except OSError:
+                continue  # Removed; its parent's refresh drops the node
+            if current == mtime:
+                continue
+            self.dir_mtimes[node] = current
+            children = {self.treeview.item(child, "text"): child
+                        for child in self.treeview.get_children(node)}
+            with os.scandir(self.node_folder(node)) as entries:
+                for entry in entries:
+                    if children.pop(entry.name, None) is None:
+                        self.insert_entry(node, entry)
+            for child in children.values():
+                self.forget_node(child)
+        self.after(TREE_REFRESH_MS, self.refresh_treeview)
 
     def update_treeview(self, folder):
         self.course_folder = folder
-        self.treeview.delete(*self.treeview.get_children())
-        self.insert_files_recursively(self.course_folder, "")
+        self.forget_node("")
+        self.insert_children("")
 
     def on_file_double_click(self, event):
         selected_item = self.treeview.selection()[0]
@@ -569,22 +1540,9 @@ class CourseApp(tk.Tk):
             text_widget.insert("1.0", f"Error opening file: {e}")
 
     def display_pdf(self, file_path, tab):
-        doc = fitz.open(file_path)
-        pdf_viewer = ttk.Notebook(tab)
+        pdf_viewer = PdfViewer(tab, file_path)
         pdf_viewer.pack(expand=True, fill="both")
 
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            pix = page.get_pixmap()
-            img_data = pix.tobytes("ppm")
-            img = Image.open(io.BytesIO(img_data))
-            photo = ImageTk.PhotoImage(image=img)
-
-            canvas = tk.Canvas(pdf_viewer, width=pix.width, height=pix.height)
-            canvas.create_image(0, 0, image=photo, anchor="nw")
-            canvas.image = photo  # Keep a reference.
-            pdf_viewer.add(canvas, text=f"Page {page_num + 1}")
-
     def display_docx(self, file_path, tab):
         document = Document(file_path)
         text_widget = tk.Text(tab, wrap="word")
@@ -602,7 +1560,23 @@ class CourseApp(tk.Tk):
                     text_widget.insert("end", shape.text + "\n")
 
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Mirror Canvas courses and study them.")
+    parser.add_argument("--batch", action="store_true",
+                        help="mirror courses without the GUI and exit")
+    parser.add_argument("--courses", nargs="*",
+                        help="course ids or parts of course names/codes to mirror (default: all)")
+    parser.add_argument("--course-workers", type=int, default=2,
+                        help="number of courses mirrored at once")
+    parser.add_argument("--concurrency", type=int, default=DOWNLOAD_CONCURRENCY,
+                        help="maximum concurrent downloads across all courses")
+    parser.add_argument("--max-bandwidth", type=float, default=None,
+                        help="total download bandwidth cap in MB/s")
+    return parser.parse_args(argv)
+
+
 def main():
+    args = parse_args()
     print(f"Current working directory: {os.getcwd()}")
     try:
         courses = canvas.get_courses()
@@ -610,13 +1584,23 @@ def main():
             print("No courses found. Exiting.")
             sys.exit(0)
 
+        if args.batch:
+            max_bandwidth = args.max_bandwidth * 1e6 if args.max_bandwidth else None
+            results = mirror_courses(courses, args.courses, args.course_workers,
+                                     args.concurrency, max_bandwidth)
+            sys.exit(1 if any(r["failures"] for r in results) else 0)
+
         selected_course = select_course(courses)
         # print_and_download_course_details(selected_course)
-        app = CourseApp(print_and_download_course_details(selected_course))
+        course_folder = print_and_download_course_details(selected_course)
+        # Re-embed only what changed in the refreshed course, in the background
+        threading.Thread(target=refresh_course_index,
+                         args=(course_folder,), daemon=True).start()
+        app = CourseApp(course_folder)
         app.mainloop()
         # app = CourseApp("CCT109H5 F LEC0101 & LEC0102",
         #                 context=f" The student is taking CCT109H5 F LEC0101 & LEC0102, offered ut the University of Toronto Mississauga.")
-        app = CourseApp(print_and_download_course_details(selected_course),
+        app = CourseApp(course_folder,
                         context=f" The student is taking {selected_course}, offered ut the University of Toronto Mississauga.")
         app.mainloop()
     except Exception as e: